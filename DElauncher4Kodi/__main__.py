@@ -16,53 +16,418 @@
 
 import sys
 import os
+import time
 import subprocess
+import argparse
+import signal
+import fcntl
+from threading import Thread
 from contextlib import contextmanager
-from .key_redirection import KeyRedirection
-from .volume_adjustment import VolumeAdjustment
+from functools import partial
+from .latency import LatencyTrace
+from .timings import Timings
+from .journal import JOURNAL_FILE, Journal, load_journal
 from . import __version__
 
 LOCKFILE = '/tmp/DElauncher4Kodi.lock'
-errmsg = ('DElauncher4Kodi already running, or did not close correctly. ' +
-          f'If the latter, remove the lock file {LOCKFILE} ' + 
-           '(or reboot) and try again.')
+# Default time allowed for shutdown, seconds:
+SHUTDOWN_DEADLINE = 5.0
 
-@contextmanager
-def lockfile(path, errmsg):
+def lock_owner(fd):
+    """Return the PID written to an open lock file, or None if there isn't
+    one"""
     try:
-        os.open(path, os.O_CREAT | os.O_EXCL)
-    except FileExistsError:
-        sys.stderr.write(errmsg + '\n')
-        sys.exit(1)
+        return int(os.pread(fd, 32, 0))
+    except ValueError:
+        return None
+
+
+@contextmanager
+def lockfile(path):
+    """Hold an exclusive lock on the file at path, with our PID written to it,
+    or exit if another process holds it. The lock is released by the kernel
+    if we are killed, so a lock file left behind does not block the next
+    run."""
+    while True:
+        try:
+            # Not following symlinks, since another user could plant one at
+            # the path to have us truncate a file of ours:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o644)
+        except PermissionError:
+            # Created by another user:
+            sys.stderr.write(f'Cannot open lock file {path}, ' +
+                             'DElauncher4Kodi may be running as another user\n')
+            sys.exit(1)
+        except OSError as e:
+            sys.stderr.write(f'Cannot open lock file {path}: {e.strerror}\n')
+            sys.exit(1)
+        if os.fstat(fd).st_uid != os.getuid():
+            os.close(fd)
+            sys.stderr.write(f'Lock file {path} belongs to another user, ' +
+                             'DElauncher4Kodi may be running as them\n')
+            sys.exit(1)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pid = lock_owner(fd)
+            os.close(fd)
+            sys.stderr.write('DElauncher4Kodi already running' +
+                             (f' with PID {pid}' if pid is not None else '') +
+                             '\n')
+            sys.exit(1)
+        # The previous holder may have deleted the file between us opening and
+        # locking it, in which case try again with the new one:
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(fd)
     try:
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, f'{os.getpid()}\n'.encode(), 0)
         yield
     finally:
+        # Delete the file before unlocking it, so that nobody can lock the
+        # deleted file:
         try:
             os.unlink(path)
-        except Exception:
+        except OSError:
+            pass
+        os.close(fd)
+
+
+def parse_target(text):
+    """Return the (host, port) of an eventserver given as host or host:port,
+    with port None if not given"""
+    host, sep, port = text.rpartition(':')
+    if not sep:
+        return text, None
+    try:
+        port = int(port)
+    except ValueError:
+        port = None
+    if not host or port is None or not 0 < port < 65536:
+        raise argparse.ArgumentTypeError(f'invalid HOST[:PORT]: {text!r}')
+    return host, port
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='DElauncher4Kodi',
+        description='Launch kodi, redirecting media keys to it and ' +
+                    'setting the system volume to 100 % whilst it runs.')
+    parser.add_argument('--trace-latency', action='store_true',
+                        help='record the latency of each input event and ' +
+                             'print statistics of them on exit')
+    parser.add_argument('--timings', action='store_true',
+                        help='print how long each phase of startup and ' +
+                             'shutdown took on exit')
+    parser.add_argument('--buttons', action='store_true',
+                        help='send media keys to kodi as button presses and ' +
+                             'releases, leaving autorepeat to kodi, instead ' +
+                             'of as an action per press and autorepeat')
+    parser.add_argument('--kodi', metavar='HOST[:PORT]', action='append',
+                        type=parse_target,
+                        help='send media keys to the kodi eventserver at ' +
+                             'HOST:PORT, port 9777 if not given. May be ' +
+                             'given more than once to send to several. ' +
+                             'Default localhost:9777')
+    parser.add_argument('--keymap', metavar='FILE',
+                        help='read key bindings from FILE instead of ' +
+                             '~/.config/DElauncher4Kodi/keymap.ini')
+    parser.add_argument('--shutdown-deadline', metavar='SECONDS', type=float,
+                        default=SHUTDOWN_DEADLINE,
+                        help='exit at most this long after kodi does, even ' +
+                             'if restoring audio has not finished. Default ' +
+                             f'{SHUTDOWN_DEADLINE}')
+    parser.add_argument('--metrics-socket', metavar='PATH',
+                        help='serve runtime counters, in the Prometheus ' +
+                             'text format, on a Unix socket at PATH instead ' +
+                             'of /tmp/DElauncher4Kodi.metrics')
+    parser.add_argument('--recover', action='store_true',
+                        help='restore the audio configuration left by an ' +
+                             'instance that was killed, and exit')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='handle input devices, kodi and signals on a ' +
+                             'single asyncio event loop instead of threads')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='command to run kodi, and its arguments')
+    return parser.parse_args()
+
+
+class LazySubsystem(object):
+    """Stand-in for a subsystem object with start() and stop() methods and a
+    running attribute, which is only constructed by calling factory() when
+    start() is first called. This defers importing the subsystem's module,
+    and its dependencies, until it is started."""
+    def __init__(self, factory):
+        self.factory = factory
+        self.subsystem = None
+
+    @property
+    def running(self):
+        return self.subsystem is not None and self.subsystem.running
+
+    def start(self, *args, **kwargs):
+        if self.subsystem is None:
+            self.subsystem = self.factory()
+        self.subsystem.start(*args, **kwargs)
+
+    def stop(self):
+        self.subsystem.stop()
+
+    def metrics(self):
+        if self.subsystem is None:
+            return []
+        return self.subsystem.metrics()
+
+
+def make_key_redirector(args, trace, timings):
+    from .key_redirection import (KeyRedirection, ACTION_MODE, BUTTON_MODE,
+                                  KEYMAP_FILE, DEFAULT_TARGETS, PORT)
+    kodi_mode = BUTTON_MODE if args.buttons else ACTION_MODE
+    keymap_file = args.keymap if args.keymap is not None else KEYMAP_FILE
+    if args.kodi is not None:
+        targets = [(host, PORT if port is None else port)
+                   for host, port in args.kodi]
+    else:
+        targets = DEFAULT_TARGETS
+    return KeyRedirection(trace=trace, timings=timings, kodi_mode=kodi_mode,
+                          keymap_file=keymap_file, targets=targets)
+
+
+def make_volume_adjuster(args, timings):
+    from .volume_adjustment import VolumeAdjustment
+    return VolumeAdjustment(timings=timings, journal=Journal(JOURNAL_FILE))
+
+
+@contextmanager
+def metrics_server(path, subsystems):
+    """Serve the metrics of the subsystems on a Unix socket at path, or the
+    default path if None, whilst in use"""
+    from .metrics import MetricsServer, METRICS_SOCKET
+
+    def collect():
+        return [m for subsystem in subsystems for m in subsystem.metrics()]
+
+    if path is None:
+        path = METRICS_SOCKET
+    server = MetricsServer(collect, path)
+    server.start()
+    try:
+        yield
+    finally:
+        server.stop()
+
+
+def recover(timings):
+    """Restore the audio configuration recorded in the journal, if any, by an
+    instance that did not shut down. Returns whether there was anything to
+    recover. Must be called with the lock held, so that the journal is not
+    that of a running instance."""
+    try:
+        state = load_journal(JOURNAL_FILE)
+    except ValueError as e:
+        sys.stderr.write(f'{e}, ignoring\n')
+        try:
+            os.unlink(JOURNAL_FILE)
+        except OSError:
+            # Another user's, in a sticky directory such as /tmp
             pass
+        return False
+    if state is None:
+        return False
+    from .volume_adjustment import recover as recover_audio
+    with timings.phase('recovery: audio restore'):
+        recover_audio(state)
+    os.unlink(JOURNAL_FILE)
+    return True
+
+
+def start_all(key_redirector, volume_adjuster, command, timings):
+    """Start key capturing and audio reconfiguration in threads, and launch
+    kodi whilst they run, since none of these depend on each other. Returns
+    the kodi Popen object once all three are done. If starting either
+    subsystem fails, kodi is terminated and the exception raised once both
+    subsystems have finished starting, so that the caller can stop whichever
+    of them did start."""
+    errors = []
+
+    def start(name, func):
+        with timings.phase(name):
+            try:
+                func()
+            except Exception as e:
+                errors.append(e)
+
+    threads = [Thread(target=start, args=('startup: key capturing',
+                                          key_redirector.start)),
+               Thread(target=start, args=('startup: audio reconfiguration',
+                                          volume_adjuster.start))]
+    for thread in threads:
+        thread.start()
+    try:
+        print('Starting kodi...')
+        with timings.phase('startup: kodi launch'):
+            kodi = subprocess.Popen(command)
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        kodi.terminate()
+        kodi.wait()
+        raise errors[0]
+    return kodi
+
+
+def stop_all(key_redirector, volume_adjuster, timings, deadline):
+    """Stop key capturing and restore audio, whichever are running, in
+    parallel. Key capturing is stopped in the calling thread, since in asyncio
+    mode it must be stopped on the event loop. If audio reconfiguration is not
+    running because starting it failed part way, the steps it completed are
+    undone by replaying the journal instead. Returns once both are done, or
+    after deadline seconds, leaving audio restoration to finish in a daemon
+    thread if it can before the process exits. Raises the first exception
+    raised by either."""
+    start_time = time.monotonic()
+    errors = []
+
+    def stop(name, func):
+        with timings.phase(name):
+            try:
+                func()
+            except Exception as e:
+                errors.append(e)
+
+    if volume_adjuster.running:
+        audio_thread = Thread(target=stop, args=('shutdown: audio restore',
+                                                 volume_adjuster.stop),
+                              daemon=True)
+    else:
+        # Does nothing if start() was not reached or undid nothing:
+        audio_thread = Thread(target=stop, args=('shutdown: audio recovery',
+                                                 partial(recover, timings)),
+                              daemon=True)
+    audio_thread.start()
+    if key_redirector.running:
+        stop('shutdown: key capturing', key_redirector.stop)
+    audio_thread.join(max(0, start_time + deadline - time.monotonic()))
+    if audio_thread.is_alive():
+        sys.stderr.write(f'Audio not restored within {deadline} s, ' +
+                         'exiting anyway\n')
+    if errors:
+        raise errors[0]
+
+
+def run_threaded(key_redirector, volume_adjuster, command, timings,
+                 deadline):
+    try:
+        kodi = start_all(key_redirector, volume_adjuster, command, timings)
+        try:
+            kodi.wait()
+        except KeyboardInterrupt:
+            kodi.kill()
+            kodi.wait()
+            sys.stderr.write('Interrupted\n')
+        else:
+            print('Kodi exited\n')
+    finally:
+        stop_all(key_redirector, volume_adjuster, timings, deadline)
+
+
+async def run_async(key_redirector, volume_adjuster, command, timings,
+                    deadline):
+    """Run kodi as an asyncio subprocess, reading input devices in callbacks
+    on the same event loop. SIGINT kills kodi and SIGTERM terminates it, after
+    which the normal shutdown happens. Shutdown is done before returning,
+    since key capturing cannot outlive the loop."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    print('Starting kodi...')
+    with timings.phase('startup: kodi launch'):
+        kodi = await asyncio.create_subprocess_exec(*command)
+    interrupted = []
+
+    def on_signal(signum):
+        interrupted.append(signum)
+        if kodi.returncode is None:
+            if signum == signal.SIGINT:
+                kodi.kill()
+            else:
+                kodi.terminate()
+
+    def start(name, func):
+        with timings.phase(name):
+            func()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, on_signal, signum)
+    try:
+        try:
+            # Set up in threads, so that neither waits on the other and the
+            # loop still handles signals meanwhile. Both are waited for before
+            # raising any exception, so that whichever started can be stopped:
+            results = await asyncio.gather(
+                loop.run_in_executor(None, start, 'startup: key capturing',
+                                     partial(key_redirector.start, loop=loop)),
+                loop.run_in_executor(None, start,
+                                     'startup: audio reconfiguration',
+                                     volume_adjuster.start),
+                return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        except Exception:
+            if kodi.returncode is None:
+                kodi.terminate()
+            await kodi.wait()
+            raise
+        await kodi.wait()
+        if interrupted:
+            sys.stderr.write('Interrupted\n')
+        else:
+            print('Kodi exited\n')
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        stop_all(key_redirector, volume_adjuster, timings, deadline)
 
 
 def main():
-    key_redirector = KeyRedirection()
-    volume_adjuster = VolumeAdjustment()
-    with lockfile(LOCKFILE, errmsg):
+    args = parse_args()
+    trace = LatencyTrace() if args.trace_latency else None
+    timings = Timings()
+    key_redirector = LazySubsystem(
+        lambda: make_key_redirector(args, trace, timings))
+    volume_adjuster = LazySubsystem(lambda: make_volume_adjuster(args, timings))
+    with lockfile(LOCKFILE):
         print(f'This is DElauncher4Kodi version {__version__}.')
         print('Please report bugs to ' +
               'github.com/chrisjbillington/DElauncher4Kodi/\n')
         try:
-            key_redirector.start()
-            volume_adjuster.start()
-            print('Starting kodi...')
-            try:
-                subprocess.call(sys.argv[1:])
-            except KeyboardInterrupt:
-                sys.stderr.write('Interrupted\n')
-            else:
-                print('Kodi exited\n')
+            if args.recover:
+                if not recover(timings):
+                    print('Nothing to recover')
+                return
+            # Undo the audio configuration of a previous instance that was
+            # killed, before recording the current one:
+            recover(timings)
+            with metrics_server(args.metrics_socket,
+                                [key_redirector, volume_adjuster]):
+                if args.asyncio:
+                    import asyncio
+                    asyncio.run(run_async(key_redirector, volume_adjuster,
+                                          args.command, timings,
+                                          args.shutdown_deadline))
+                else:
+                    run_threaded(key_redirector, volume_adjuster,
+                                 args.command, timings, args.shutdown_deadline)
         finally:
-            key_redirector.stop()
-            volume_adjuster.stop()
+            if trace is not None:
+                trace.report()
+            if args.timings:
+                timings.report()
             print('Done')
 if __name__ == '__main__':
     main()
\ No newline at end of file
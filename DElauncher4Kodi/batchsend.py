@@ -0,0 +1,125 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Sending a datagram to several addresses in one system call.
+
+Uses sendmmsg() from the C library via ctypes, where available, otherwise a
+sendto() per address."""
+
+import os
+import ctypes
+import socket
+from struct import Struct
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _sendmmsg = _libc.sendmmsg
+except (OSError, AttributeError):
+    _sendmmsg = None
+
+# struct sockaddr_in from netinet/in.h: sa_family_t family in native byte
+# order, port and address in network byte order, and padding:
+SOCKADDR_IN = Struct('=H2s4s8x')
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                          ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+
+def sockaddr_in(addr):
+    """Return a ctypes buffer containing the struct sockaddr_in of an IPv4
+    (address, port) pair"""
+    host, port = addr
+    return ctypes.create_string_buffer(
+        SOCKADDR_IN.pack(socket.AF_INET, port.to_bytes(2, 'big'),
+                         socket.inet_aton(host)), SOCKADDR_IN.size)
+
+
+class BatchSender(object):
+    """Send datagrams from an IPv4 UDP socket to each of a list of (address,
+    port) pairs, in order, with a single sendmmsg() system call, or a
+    sendto() each if use_sendmmsg is False, sendmmsg() is not available, or
+    there is only one address. Not thread-safe: send() points one shared iovec
+    at each datagram, so it must only be called from one thread at a time."""
+    def __init__(self, sock, addrs, use_sendmmsg=True):
+        self.sock = sock
+        self.addrs = list(addrs)
+        self.batched = (use_sendmmsg and _sendmmsg is not None and
+                        len(self.addrs) > 1)
+        # Datagram: its address in memory, for datagrams already sent. Keeps
+        # them alive, so that their addresses remain valid:
+        self.buffers = {}
+        if self.batched:
+            # Every message has the same single iovec, pointed at the datagram
+            # being sent:
+            self.iov = iovec()
+            self.names = [sockaddr_in(addr) for addr in self.addrs]
+            self.msgs = (mmsghdr * len(self.addrs))()
+            for msg, name in zip(self.msgs, self.names):
+                msg.msg_hdr.msg_name = ctypes.addressof(name)
+                msg.msg_hdr.msg_namelen = SOCKADDR_IN.size
+                msg.msg_hdr.msg_iov = ctypes.pointer(self.iov)
+                msg.msg_hdr.msg_iovlen = 1
+
+    def send(self, datagram, start=0):
+        """Send the datagram to the addresses from index start onward. Returns
+        the number of addresses it was sent to before any error. If an error
+        occurs before any are sent to, it is raised as an OSError."""
+        if not self.batched:
+            n_sent = 0
+            for addr in self.addrs[start:]:
+                try:
+                    self.sock.sendto(datagram, addr)
+                except OSError:
+                    if not n_sent:
+                        raise
+                    break
+                n_sent += 1
+            return n_sent
+        try:
+            self.iov.iov_base = self.buffers[datagram]
+        except KeyError:
+            pointer = ctypes.cast(ctypes.c_char_p(datagram), ctypes.c_void_p)
+            self.iov.iov_base = self.buffers[datagram] = pointer.value
+        self.iov.iov_len = len(datagram)
+        msgs = ctypes.addressof(self.msgs) + start * ctypes.sizeof(mmsghdr)
+        n_sent = _sendmmsg(self.sock.fileno(), msgs, len(self.addrs) - start, 0)
+        if n_sent < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return n_sent
@@ -0,0 +1,165 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""A local stand-in for Kodi's EventServer, for benchmarking and testing
+KodiClient and XBMCClient against a real UDP socket without Kodi installed.
+Run as:
+
+    python3 -m DElauncher4Kodi.eventserver [port]
+
+to print what it receives."""
+
+import sys
+import os
+import time
+import selectors
+import struct
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF
+from threading import Thread, Condition
+from collections import namedtuple
+
+from .xbmcclient import (MessageAssembler, decode_payload, MAX_PACKET_SIZE,
+                         PT_ACTION, PT_BUTTON)
+
+# Receive buffer size, large so that bursts are not lost before being read:
+RCVBUF_SIZE = 4 * 1024 * 1024
+
+Received = namedtuple('Received', ['timestamp', 'packettype', 'uid', 'payload'])
+
+
+class EventServer(object):
+    """Receive and decode eventserver packets on a UDP socket in a thread,
+    recording each complete message as a Received tuple with the time.time()
+    at which its last packet arrived. port=0 binds to a free port, the bound
+    address is self.addr."""
+    def __init__(self, host='127.0.0.1', port=0):
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.setsockopt(SOL_SOCKET, SO_RCVBUF, RCVBUF_SIZE)
+        self.sock.bind((host, port))
+        self.addr = self.sock.getsockname()
+        self.assembler = MessageAssembler()
+        self.received = []
+        self.n_packets = 0
+        self.n_bytes = 0
+        self.n_invalid = 0
+        self.condition = Condition()
+        self.thread = None
+        self.stop_fd_reader = None
+        self.stop_fd_writer = None
+
+    def start(self):
+        self.stop_fd_reader, self.stop_fd_writer = os.pipe()
+        self.thread = Thread(target=self.mainloop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.stop_fd_writer, b'stop')
+        os.close(self.stop_fd_writer)
+        self.stop_fd_writer = None
+        self.thread.join()
+        self.thread = None
+        self.sock.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def mainloop(self):
+        buffer = bytearray(MAX_PACKET_SIZE)
+        view = memoryview(buffer)
+        self.sock.setblocking(False)
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            selector.register(self.stop_fd_reader, selectors.EVENT_READ)
+            while True:
+                ready = [key.fileobj for key, _ in selector.select()]
+                if self.stop_fd_reader in ready:
+                    os.close(self.stop_fd_reader)
+                    self.stop_fd_reader = None
+                    return
+                while True:
+                    try:
+                        size = self.sock.recv_into(buffer)
+                    except BlockingIOError:
+                        break
+                    self.handle_message(view[:size])
+
+    def handle_message(self, data):
+        timestamp = time.time()
+        received = None
+        try:
+            message = self.assembler.feed(data)
+            if message is not None:
+                header, payload = message
+                payload = decode_payload(header.packettype, payload)
+                received = Received(timestamp, header.packettype, header.uid,
+                                    payload)
+        except (ValueError, IndexError, struct.error):
+            # Malformed, such as a truncated payload or invalid UTF-8:
+            self.n_invalid += 1
+        with self.condition:
+            self.n_packets += 1
+            self.n_bytes += len(data)
+            if received is not None:
+                self.received.append(received)
+            self.condition.notify_all()
+
+    def wait_for(self, n_packets, timeout=None):
+        """Wait until at least n_packets UDP messages have been received.
+        Returns whether they were received before the timeout"""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.n_packets >= n_packets, timeout)
+
+    def actions(self):
+        """Return a list of (timestamp, actionmessage) for received actions"""
+        with self.condition:
+            return [(r.timestamp, r.payload.actionmessage)
+                    for r in self.received if r.packettype == PT_ACTION]
+
+    def buttons(self):
+        """Return a list of (timestamp, ButtonPayload) for received buttons"""
+        with self.condition:
+            return [(r.timestamp, r.payload)
+                    for r in self.received if r.packettype == PT_BUTTON]
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9777
+    server = EventServer(port=port)
+    print(f'Listening on {server.addr[0]}:{server.addr[1]}')
+    server.start()
+    n_printed = 0
+    try:
+        while True:
+            server.wait_for(server.n_packets + 1)
+            with server.condition:
+                new = server.received[n_printed:]
+                n_printed = len(server.received)
+            for received in new:
+                print(f'{received.timestamp:.6f} type 0x{received.packettype:02x} '
+                      f'uid {received.uid}: {received.payload}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
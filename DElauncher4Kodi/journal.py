@@ -0,0 +1,82 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""A small journal of state that must outlive the process if it is killed.
+
+The journal is a JSON object, rewritten in full on each update by writing a
+temporary file and renaming it over the journal, so that it is always either
+the old or the new state, never a mixture of the two."""
+
+import os
+import json
+import tempfile
+
+JOURNAL_FILE = '/tmp/DElauncher4Kodi.journal'
+
+
+def load_journal(path=JOURNAL_FILE):
+    """Return the state recorded in the journal at path as a dict, or None if
+    there is no journal. Raises ValueError if the journal is unreadable."""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        raise ValueError(f'Error reading journal {path}: {e}') from None
+    with os.fdopen(fd) as f:
+        # Only trust a journal that we wrote:
+        if os.fstat(fd).st_uid != os.getuid():
+            raise ValueError(f'Error reading journal {path}: not our file')
+        try:
+            state = json.load(f)
+        except ValueError as e:
+            raise ValueError(f'Error reading journal {path}: {e}') from None
+    if not isinstance(state, dict):
+        raise ValueError(f'Error reading journal {path}: not a JSON object')
+    return state
+
+
+class Journal(object):
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.state = {}
+
+    def update(self, **fields):
+        """Add the fields to the recorded state and write it to the journal"""
+        self.state.update(fields)
+        # A new file with a unique name, since in a shared directory such as
+        # /tmp another user could have planted a symlink at a predictable one:
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.path),
+            prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.state, f)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        # No fsync, since the state is only meaningful until the PulseAudio
+        # server restarts, as it would after a power loss:
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        """Delete the journal, once the state it records no longer needs
+        undoing"""
+        self.state = {}
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
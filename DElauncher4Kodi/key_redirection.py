@@ -15,19 +15,54 @@
 #   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os
-from select import select
-from socket import socket, AF_INET, SOCK_DGRAM
-from threading import Thread, Event
-from collections import defaultdict
+import time
+import selectors
+from socket import (socket, gethostbyname, AF_INET, SOCK_DGRAM, IPPROTO_IP,
+                    MSG_ERRQUEUE)
+from struct import Struct, calcsize
+from threading import Thread, Event, Lock
+from collections import defaultdict, deque
+from contextlib import ExitStack
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import evdev
 import evdev.ecodes as ev
 
-from .xbmcclient import PacketACTION, ACTION_BUTTON
+from .xbmcclient import (PacketACTION, PacketBUTTON, PacketHELO, PacketPING,
+                         PacketBYE, ACTION_BUTTON, ACTION_EXECBUILTIN)
+from .keymap import (Binding, KeyMap, load_keymap, ACTION, BUTTON, BUILTIN,
+                     DEFAULT_BUTTON_MAP, KEYMAP_FILE)
+from .batchsend import BatchSender
+from .timings import Timings
+from .metrics import Metric, COUNTER, GAUGE
 
 
 # Kodi eventserver details:
 HOST = 'localhost'
 PORT = 9777
+CLIENT_NAME = 'DElauncher4Kodi'
+DEFAULT_TARGETS = [(HOST, PORT)]
+
+# Kodi drops clients it hasn't heard from in 60 seconds. If nothing else has
+# been sent for PING_INTERVAL, a ping is sent. Sends that are refused show
+# that a Kodi has gone down, and whilst any is down, every KEEPALIVE_INTERVAL
+# we check whether it is back up, in which case the HELO handshake with it is
+# redone. Seconds:
+PING_INTERVAL = 20.0
+KEEPALIVE_INTERVAL = 1.0
+
+# Until Kodi's eventserver is up, up to REPLAY_QUEUE_SIZE datagrams are queued,
+# dropping the oldest when full, and replayed once it is up unless older than
+# REPLAY_MAX_AGE seconds:
+REPLAY_QUEUE_SIZE = 16
+REPLAY_MAX_AGE = 5.0
+
+# From linux/in.h, not exposed by the socket module. Has ICMP errors queued on
+# the socket along with the address of the datagram that caused them:
+IP_RECVERR = 11
+
+# Where the kernel lists bound UDP sockets:
+PROC_NET_UDP = ['/proc/net/udp', '/proc/net/udp6']
 
 # Mapping of keys to kodi actions:
 MEDIA_KEYS = {ev.KEY_MUTE: "Mute",
@@ -42,81 +77,748 @@ MEDIA_KEYS = {ev.KEY_MUTE: "Mute",
               ev.KEY_REWIND: "Rewind",
               ev.KEY_FASTFORWARD: "FastForward"}
 
+# Bindings of keys used for all devices unless overridden by the key map file:
+DEFAULT_BINDINGS = {key: Binding(ACTION, action, None)
+                    for key, action in MEDIA_KEYS.items()}
+
+# Buttons in the remote ("R1") section of kodi's keymaps corresponding to each
+# action, for sending key presses and releases as button events:
+KODI_BUTTONS = {"Mute": "mute",
+                "VolumeDown": "volumeminus",
+                "VolumeUp": "volumeplus",
+                "Play": "play",
+                "Pause": "pause",
+                "PlayPause": "playpause",
+                "Stop": "stop",
+                "SkipNext": "skipplus",
+                "SkipPrevious": "skipminus",
+                "Rewind": "reverse",
+                "FastForward": "forward"}
+
+# Ways of sending keys to Kodi. Either an action per press and autorepeat, or a
+# button down on press and button up on release, leaving repeats to Kodi:
+ACTION_MODE = 'action'
+BUTTON_MODE = 'button'
+
+# Where the kernel describes input devices, and the number of bits in each
+# word of the capability bitmaps it gives there:
+SYSFS_INPUT = '/sys/class/input'
+BITMAP_WORD_BITS = 8 * calcsize('l')
+
+# Maximum number of devices to open, probe or grab at once:
+MAX_DEVICE_THREADS = 8
+
+# Dispatch tables have an entry for each event type and code, at index
+# type * KEY_CNT + code, since no event type has more codes than keys:
+KEY_CNT = ev.KEY_CNT
+DISPATCH_TABLE_SIZE = ev.EV_CNT * KEY_CNT
+
 # Key events:
 PRESS = evdev.events.KeyEvent.key_down
 RELEASE = evdev.events.KeyEvent.key_up
 HOLD = evdev.events.KeyEvent.key_hold
 
 
-class KodiClient(object):
+class RepeatPolicy(object):
+    """How autorepeats of a held key are sent to Kodi. Repeats are sent at
+    most at a rate that accelerates from initial_rate to max_rate (in Hz) over
+    the first ramp seconds of holding the key, with the fraction of the ramp
+    completed raised to the power curve. Repeats arriving faster than that are
+    dropped. A max_rate of zero means repeats are never sent."""
+    def __init__(self, initial_rate=5.0, max_rate=10.0, ramp=1.0, curve=1.0):
+        self.initial_rate = initial_rate
+        self.max_rate = max_rate
+        self.ramp = ramp
+        self.curve = curve
+
+    def interval(self, held):
+        """Minimum interval between repeats sent after the key has been held
+        for the given time, or None if no repeats are to be sent"""
+        if not self.max_rate:
+            return None
+        if held >= self.ramp:
+            return 1 / self.max_rate
+        fraction = (held / self.ramp) ** self.curve
+        return 1 / (self.initial_rate + (self.max_rate - self.initial_rate) * fraction)
+
+
+NO_REPEAT = RepeatPolicy(max_rate=0)
+
+# How autorepeats of each kodi action are sent. Toggles are never repeated,
+# since holding them would flip the state back and forth:
+REPEAT_POLICIES = {"Mute": NO_REPEAT,
+                   "VolumeDown": RepeatPolicy(initial_rate=8, max_rate=20, ramp=2),
+                   "VolumeUp": RepeatPolicy(initial_rate=8, max_rate=20, ramp=2),
+                   "Play": NO_REPEAT,
+                   "Pause": NO_REPEAT,
+                   "PlayPause": NO_REPEAT,
+                   "Stop": NO_REPEAT,
+                   "SkipNext": RepeatPolicy(initial_rate=2, max_rate=4),
+                   "SkipPrevious": RepeatPolicy(initial_rate=2, max_rate=4),
+                   "Rewind": RepeatPolicy(initial_rate=2, max_rate=4),
+                   "FastForward": RepeatPolicy(initial_rate=2, max_rate=4)}
+
+# The policy for actions not in REPEAT_POLICIES, unless it has one under this
+# name:
+DEFAULT_REPEAT = 'default'
+DEFAULT_REPEAT_POLICY = RepeatPolicy()
+
+# struct input_event from linux/input.h: struct timeval time, __u16 type,
+# __u16 code, __s32 value:
+INPUT_EVENT = Struct('llHHi')
+
+# Number of events initially buffered for each device's pending frame. Longer
+# frames grow the buffer:
+MAX_FRAME_EVENTS = 64
+
+
+def action_datagram(name, actiontype=ACTION_BUTTON):
+    """Build the UDP datagram for a Kodi action, or builtin if actiontype is
+    ACTION_EXECBUILTIN, so that nothing needs to be encoded when a key is
+    pressed"""
+    packet = PacketACTION(actionmessage=name, actiontype=actiontype)
+    if packet.num_packets() != 1:
+        raise ValueError(f'Action too long: {name!r}')
+    return packet.get_udp_message()
+
+
+def button_datagrams(button_map, name):
+    """Build the UDP datagrams for the button down and button up events of a
+    Kodi button. Returns (down datagram, up datagram)"""
+    down, up = [PacketBUTTON(map_name=button_map, button_name=name, down=down,
+                             repeat=1)
+                for down in (1, 0)]
+    if down.num_packets() != 1:
+        raise ValueError(f'Button name too long: {name!r}')
+    return down.get_udp_message(), up.get_udp_message()
+
+
+class ActionKey(object):
+    """Dispatch table entry sending a precompiled action datagram when the key
+    is pressed, and for autorepeats at the rate allowed by a RepeatPolicy.
+    Times are kernel event timestamps."""
+    __slots__ = ('client', 'datagram', 'policy', 'press_time', 'last_sent')
+
+    def __init__(self, client, datagram, policy):
+        self.client = client
+        self.datagram = datagram
+        self.policy = policy
+        self.press_time = None
+        self.last_sent = None
+
+    def __call__(self, event):
+        value = event.value
+        if value == RELEASE:
+            # No further repeats are sent even if they arrive:
+            self.press_time = None
+            return
+        t = event.sec + event.usec * 1e-6
+        if value == PRESS or self.press_time is None:
+            # For an autorepeat, the press was not seen, e.g. held since
+            # before we started:
+            self.press_time = self.last_sent = t
+            if value != PRESS:
+                return
+        else:
+            interval = self.policy.interval(t - self.press_time)
+            if interval is None or t - self.last_sent < interval:
+                return
+            self.last_sent = t
+        self.client.send_key(self.datagram, event)
+
+
+class ButtonKey(object):
+    """Dispatch table entry sending a button down when the key is pressed and
+    a button up when it is released. Kodi repeats held buttons itself, so
+    autorepeats are ignored."""
+    __slots__ = ('client', 'down', 'up')
+
+    def __init__(self, client, down, up):
+        self.client = client
+        self.down = down
+        self.up = up
+
+    def __call__(self, event):
+        value = event.value
+        if value == PRESS:
+            self.client.send_key(self.down, event)
+        elif value == RELEASE:
+            self.client.send_key(self.up, event)
+
+
+def udp_port_bound(port):
+    """Return whether a UDP socket on this host is bound to the port, or None
+    if this can't be determined"""
+    found_table = False
+    for path in PROC_NET_UDP:
+        try:
+            f = open(path)
+        except OSError:
+            continue
+        found_table = True
+        with f:
+            # Skip the header:
+            next(f, None)
+            for line in f:
+                local_address = line.split()[1]
+                if int(local_address.rsplit(':', 1)[1], 16) == port:
+                    return True
+    return False if found_table else None
+
+
+class EventServerTarget(object):
+    """One Kodi eventserver that KodiClient sends to, and the state of the
+    session with it. Until it is up, datagrams for it are queued."""
     def __init__(self, host, port):
-        self.addr = (host, port)
-        self.sock = socket(AF_INET, SOCK_DGRAM)
+        # Resolved once, so that sends don't have to:
+        self.addr = (gethostbyname(host), port)
+        # Whether we can check if the eventserver is up without sending to it:
+        self.is_local = self.addr[0].startswith('127.')
+        # If we can't tell, assume the eventserver is up until told otherwise:
+        self.up = self.port_bound() is not False
         self.have_said_hello = False
+        # Whether a HELO has been sent since it went down, which if not
+        # refused shows it is back up:
+        self.probed = False
+        # (time queued, datagram) for datagrams awaiting the eventserver:
+        self.queue = deque(maxlen=REPLAY_QUEUE_SIZE)
+        self.queue_lock = Lock()
+        self.n_dropped = 0
+        self.n_expired = 0
+
+    def port_bound(self):
+        """Return whether the eventserver's port is bound, or None if this
+        can't be determined"""
+        if not self.is_local:
+            return None
+        return udp_port_bound(self.addr[1])
+
+    def enqueue(self, datagram):
+        if len(self.queue) == self.queue.maxlen:
+            self.n_dropped += 1
+        self.queue.append((time.monotonic(), datagram))
 
-    def send_action(self, action):
-        packet = PacketACTION(actionmessage=action, actiontype=ACTION_BUTTON)
-        packet.send(self.sock, self.addr)
-
-    def handle_event(self, event):
-        """Check if this is an event we are interested in, and handle it
-        appropriately. Return True if we handled it and False if we did not."""
-        if event.type == ev.EV_KEY:
-            key = event.code
-            if key in MEDIA_KEYS:
-                if event.value in [PRESS, HOLD]:
-                    self.send_action(MEDIA_KEYS[key])
+
+class KodiClient(object):
+    def __init__(self, targets=DEFAULT_TARGETS, keymap=None, trace=None,
+                 repeat_policies=REPEAT_POLICIES, mode=ACTION_MODE,
+                 use_sendmmsg=True):
+        """Send key events to the Kodi eventservers at targets, a list of
+        (host, port) pairs, according to keymap, a keymap.KeyMap, by default
+        DEFAULT_BINDINGS for all devices. In BUTTON_MODE, keys bound to
+        actions with a Kodi button in KODI_BUTTONS are sent as that button
+        instead, otherwise mode is ACTION_MODE. Autorepeats of actions are
+        sent according to repeat_policies, a dict of action name:
+        RepeatPolicy, with that under DEFAULT_REPEAT for other actions, as
+        overridden by the keymap's [repeat] section. Each datagram is sent to
+        all targets in one system call, unless use_sendmmsg is False."""
+        # Targets given more than once, possibly under different names such as
+        # localhost and 127.0.0.1, are one eventserver, and must be one
+        # target to be sent to once and marked down when refused:
+        self.targets_by_addr = {}
+        for host, port in targets:
+            target = EventServerTarget(host, port)
+            self.targets_by_addr.setdefault(target.addr, target)
+        # Local targets first, so that delivery to them doesn't wait on the
+        # sends to remote ones:
+        self.targets = sorted(self.targets_by_addr.values(),
+                              key=lambda target: not target.is_local)
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.setblocking(False)
+        # Kodi tells clients apart by address, so every datagram must come
+        # from the same port:
+        self.sock.bind(('', 0))
+        try:
+            self.sock.setsockopt(IPPROTO_IP, IP_RECVERR, 1)
+        except OSError:
+            # Refusals won't be detected, only whether local ports are bound
+            pass
+        self.use_sendmmsg = use_sendmmsg
+        self.routing_lock = Lock()
+        self.routing = None
+        self.update_routing()
+        self.hello_datagram = PacketHELO(devicename=CLIENT_NAME).get_udp_message()
+        self.ping_datagram = PacketPING().get_udp_message()
+        self.bye_datagram = PacketBYE().get_udp_message()
+        self.keepalive_thread = None
+        self.stopping = False
+        # Set to wake the keepalive thread when stopping or a target goes down:
+        self.wake = Event()
+        self.last_send_time = time.monotonic()
+        self.n_send_errors = 0
+        # Updated without a lock from the keepalive thread as well as the one
+        # sending key events, so may very rarely miss a count:
+        self.n_datagrams_sent = 0
+        self.n_bytes_sent = 0
+        self.keymap = keymap if keymap is not None else KeyMap(DEFAULT_BINDINGS)
+        if mode not in (ACTION_MODE, BUTTON_MODE):
+            raise ValueError(f'Invalid mode {mode!r}')
+        self.mode = mode
+        self.repeat_policies = dict(repeat_policies)
+        self.repeat_policies.setdefault(DEFAULT_REPEAT, DEFAULT_REPEAT_POLICY)
+        # Parameters given in the keymap override those of the given policy:
+        for action, params in self.keymap.repeat.items():
+            if params is None:
+                self.repeat_policies[action] = NO_REPEAT
+            else:
+                base = self.repeat_policies.get(
+                    action, self.repeat_policies[DEFAULT_REPEAT])
+                self.repeat_policies[action] = RepeatPolicy(
+                    **dict(vars(base), **params))
+        self.trace = trace
+        self.n_sent = 0
+        # Dispatch tables by the names of the keymap profiles they are of, and
+        # by device file:
+        self.tables = {}
+        self.device_tables = {}
+        self.table = self.compile_table(())
+        for target in self.targets:
+            if target.up:
+                self.say_hello(target)
+
+    def __enter__(self):
+        self.start_keepalive()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update_routing(self):
+        """Update which targets datagrams are sent to, and which they are
+        queued for, according to which targets are up"""
+        with self.routing_lock:
+            live = [target for target in self.targets if target.up]
+            down = [target for target in self.targets if not target.up]
+            sender = BatchSender(self.sock, [target.addr for target in live],
+                                 use_sendmmsg=self.use_sendmmsg)
+            # Replaced as a whole, so that send() needs no lock to read it:
+            self.routing = (live, down, sender)
+
+    def check_errors(self):
+        """Mark as down the targets that refused datagrams, according to the
+        socket's error queue"""
+        while True:
+            try:
+                _, _, _, addr = self.sock.recvmsg(1, 1024, MSG_ERRQUEUE)
+            except OSError:
+                # Queue empty
+                return
+            target = self.targets_by_addr.get(addr)
+            if target is not None:
+                self.server_down(target)
+
+    def transmit(self, target, datagram):
+        """Send a datagram to one target now, returning whether it was sent"""
+        for attempt in range(2):
+            try:
+                self.sock.sendto(datagram, target.addr)
+            except ConnectionRefusedError:
+                # Reported for an earlier datagram, to any target:
+                self.check_errors()
+            except OSError:
+                self.n_send_errors += 1
+                return False
+            else:
+                self.n_datagrams_sent += 1
+                self.n_bytes_sent += len(datagram)
                 return True
         return False
 
+    def send_batch(self, sender, datagram):
+        """Send a datagram to all addresses of a BatchSender"""
+        n_addrs = len(sender.addrs)
+        n_sent = 0
+        while n_sent < n_addrs:
+            try:
+                n = sender.send(datagram, n_sent)
+                n_sent += n
+                self.n_datagrams_sent += n
+                self.n_bytes_sent += n * len(datagram)
+            except ConnectionRefusedError:
+                # Reported for an earlier datagram, to any target. Find out
+                # which, and send to or queue for the rest one by one:
+                self.check_errors()
+                for addr in sender.addrs[n_sent:]:
+                    self.send_or_queue(self.targets_by_addr[addr], datagram)
+                return
+            except OSError:
+                # Socket buffer full or target unreachable, skip the target:
+                self.n_send_errors += 1
+                n_sent += 1
+
+    def send_or_queue(self, target, datagram):
+        """Send a datagram to one target if it is up, otherwise queue it"""
+        with target.queue_lock:
+            if not target.up:
+                target.enqueue(datagram)
+                return
+        if not self.transmit(target, datagram) and not target.up:
+            with target.queue_lock:
+                target.enqueue(datagram)
+
+    def send(self, datagram):
+        """Send a datagram to all targets that are up, and queue it for those
+        that are not"""
+        live, down, sender = self.routing
+        self.last_send_time = time.monotonic()
+        if live:
+            self.send_batch(sender, datagram)
+        for target in down:
+            self.send_or_queue(target, datagram)
+
+    def server_down(self, target):
+        """Queue datagrams for the target until it is back up"""
+        target.probed = False
+        target.have_said_hello = False
+        if target.up:
+            target.up = False
+            self.update_routing()
+            self.wake.set()
+
+    def server_up(self, target):
+        """Say hello and replay queued datagrams that have not expired, then
+        send datagrams directly again. Returns whether successful."""
+        with target.queue_lock:
+            if not self.say_hello(target):
+                return False
+            now = time.monotonic()
+            while target.queue:
+                queued_time, datagram = target.queue.popleft()
+                if now - queued_time > REPLAY_MAX_AGE:
+                    target.n_expired += 1
+                elif not self.transmit(target, datagram):
+                    target.queue.appendleft((queued_time, datagram))
+                    return False
+            target.up = True
+        self.update_routing()
+        return True
+
+    def say_hello(self, target):
+        """Send a HELO packet, which kodi requires before button events"""
+        target.have_said_hello = self.transmit(target, self.hello_datagram)
+        return target.have_said_hello
+
+    def send_key(self, datagram, event):
+        """Send a datagram in response to the given event"""
+        self.send(datagram)
+        self.n_sent += 1
+        if self.trace is not None:
+            self.trace.kodi.record(event)
+
+    def make_handler(self, binding):
+        """Return the dispatch table entry for a key with the given Binding"""
+        if binding.kind == ACTION:
+            if self.mode == BUTTON_MODE and binding.name in KODI_BUTTONS:
+                return ButtonKey(self, *button_datagrams(
+                    DEFAULT_BUTTON_MAP, KODI_BUTTONS[binding.name]))
+            policy = self.repeat_policies.get(
+                binding.name, self.repeat_policies[DEFAULT_REPEAT])
+            return ActionKey(self, action_datagram(binding.name), policy)
+        if binding.kind == BUILTIN:
+            datagram = action_datagram(binding.name, ACTION_EXECBUILTIN)
+            return ActionKey(self, datagram, NO_REPEAT)
+        if binding.kind == BUTTON:
+            return ButtonKey(self, *button_datagrams(binding.button_map,
+                                                     binding.name))
+        raise ValueError(f'Invalid binding {binding!r}')
+
+    def compile_table(self, profile_names):
+        """Return a dispatch table for the keys bound by the given profiles of
+        the keymap. This is a list of an entry for every event type and code,
+        at index type * KEY_CNT + code, which is None for events not sent to
+        Kodi, and otherwise is to be called with the event."""
+        table = [None] * DISPATCH_TABLE_SIZE
+        for key, binding in self.keymap.bindings(profile_names).items():
+            try:
+                handler = self.make_handler(binding)
+            except ValueError as e:
+                section = next((name for name in reversed(profile_names)
+                                if key in self.keymap.profiles[name]), 'all')
+                key_name = ev.KEY.get(key, key)
+                if isinstance(key_name, list):
+                    key_name = key_name[0]
+                raise ValueError(f'{e} for {key_name} in key map section ' +
+                                 f'[{section}]') from None
+            table[ev.EV_KEY * KEY_CNT + key] = handler
+        self.tables[profile_names] = table
+        return table
+
+    def dispatch_table(self, device):
+        """Return the dispatch table for the keys of the given device"""
+        try:
+            return self.device_tables[device.fn]
+        except KeyError:
+            pass
+        profile_names = self.keymap.profile_names(device)
+        table = self.tables.get(profile_names)
+        if table is None:
+            table = self.compile_table(profile_names)
+        self.device_tables[device.fn] = table
+        return table
+
+    def start_keepalive(self):
+        """Start a thread keeping the session alive, and watching for the
+        eventserver to come up if it is down, such as before Kodi starts"""
+        self.keepalive_thread = Thread(target=self.keepalive, daemon=True)
+        self.keepalive_thread.start()
+
+    def keepalive(self):
+        """Whilst all targets are up, sleep until a ping is due. Whilst any is
+        down, check every KEEPALIVE_INTERVAL whether it has come back up."""
+        while True:
+            _, down, _ = self.routing
+            if down:
+                timeout = KEEPALIVE_INTERVAL
+            else:
+                ping_time = self.last_send_time + PING_INTERVAL
+                timeout = max(0.0, ping_time - time.monotonic())
+            self.wake.wait(timeout)
+            # Cleared before looking at the targets, so that a target going
+            # down after we look wakes us again:
+            self.wake.clear()
+            if self.stopping:
+                return
+            self.check_errors()
+            for target in self.targets:
+                if not target.up:
+                    self.revive(target)
+            if time.monotonic() - self.last_send_time >= PING_INTERVAL:
+                live, _, _ = self.routing
+                self.last_send_time = time.monotonic()
+                # One by one, since the BatchSender is the sending thread's:
+                for target in live:
+                    self.transmit(target, self.ping_datagram)
+
+    def revive(self, target):
+        """Check whether a target that is down has come up, and if so, resume
+        sending to it"""
+        bound = target.port_bound()
+        if bound or (bound is None and target.probed):
+            self.server_up(target)
+        elif bound is None:
+            # If refused, check_errors() will find out on the next tick:
+            target.probed = self.transmit(target, self.hello_datagram)
+
+    def close(self):
+        """Stop the keepalive thread and end the sessions. Datagrams still
+        queued are discarded."""
+        if self.keepalive_thread is not None:
+            self.stopping = True
+            self.wake.set()
+            self.keepalive_thread.join()
+            self.keepalive_thread = None
+        live, _, sender = self.routing
+        if live:
+            self.send_batch(sender, self.bye_datagram)
+        self.sock.close()
+
+    def metrics(self):
+        """Return a list of metrics.Metric of the datagrams sent and of each
+        target's session"""
+        def per_target(value):
+            return [({'target': f'{target.addr[0]}:{target.addr[1]}'},
+                     int(value(target))) for target in self.targets]
+
+        return [
+            Metric('kodi_key_datagrams_total', 'Key events sent to kodi',
+                   COUNTER, [({}, self.n_sent)]),
+            Metric('kodi_datagrams_sent_total',
+                   'Datagrams sent to kodi eventservers, counting each target',
+                   COUNTER, [({}, self.n_datagrams_sent)]),
+            Metric('kodi_bytes_sent_total',
+                   'Bytes sent to kodi eventservers, counting each target',
+                   COUNTER, [({}, self.n_bytes_sent)]),
+            Metric('kodi_send_errors_total', 'Datagrams that failed to send',
+                   COUNTER, [({}, self.n_send_errors)]),
+            Metric('kodi_target_up', 'Whether the kodi eventserver is up',
+                   GAUGE, per_target(lambda target: target.up)),
+            Metric('kodi_target_queued', 'Datagrams queued for the eventserver',
+                   GAUGE, per_target(lambda target: len(target.queue))),
+            Metric('kodi_target_dropped_total',
+                   'Queued datagrams dropped because the queue was full',
+                   COUNTER, per_target(lambda target: target.n_dropped)),
+            Metric('kodi_target_expired_total',
+                   'Queued datagrams discarded as too old to replay',
+                   COUNTER, per_target(lambda target: target.n_expired)),
+        ]
+
+    def handle_event(self, event, device=None):
+        """Send the event to Kodi if it is bound in the dispatch table of the
+        device, or in the default one if device is None. Return True if we
+        handled it and False if we did not."""
+        table = self.table if device is None else self.dispatch_table(device)
+        handler = table[event.type * KEY_CNT + event.code]
+        if handler is None:
+            return False
+        handler(event)
+        return True
+
+
+class FrameWriter(object):
+    """Buffer events to be forwarded to a uinput device, and write them to it
+    as one frame in a single write() when the source device's SYN_REPORT
+    arrives. The SYN_REPORT is forwarded along with the rest of the frame, so
+    no additional sync is needed.
+
+    Each source device has its own pending frame, keyed by its file
+    descriptor. The kernel holds events written to the uinput device until a
+    SYN_REPORT, so any part of one device's frame written before another
+    device's SYN_REPORT would be merged into that device's frame."""
+    def __init__(self, ui, trace=None):
+        self.fd = ui.fd
+        self.trace = trace
+        # [buffer, offset] of the pending frame of each source device:
+        self.pending = {}
+
+    def write_event(self, source, event):
+        """Buffer an event read from the device with file descriptor source,
+        writing out its frame if the event is a SYN_REPORT"""
+        frame = self.pending.get(source)
+        if frame is None:
+            frame = self.pending[source] = [
+                bytearray(INPUT_EVENT.size * MAX_FRAME_EVENTS), 0]
+        buffer, offset = frame
+        if offset == len(buffer):
+            # Rather than write out part of the frame, double the buffer. It
+            # is extended in place, so frame[0] remains the same object:
+            buffer.extend(bytes(len(buffer)))
+        INPUT_EVENT.pack_into(buffer, offset, event.sec, event.usec,
+                              event.type, event.code, event.value)
+        offset += INPUT_EVENT.size
+        if event.type == ev.EV_SYN and event.code == ev.SYN_REPORT:
+            os.write(self.fd, memoryview(buffer)[:offset])
+            offset = 0
+            if self.trace is not None:
+                self.trace.uinput.record(event)
+        frame[1] = offset
+
 
 def longname(device):
     return f'{device.fn}: {device.name}'
 
-def get_mediakey_devices():
-    """Find all input devices that have any of given media keys."""
+
+def parse_bitmap(text):
+    """Return as an int a capability bitmap as shown in sysfs: hex words, most
+    significant first, with leading zero words omitted"""
+    return int(''.join(word.zfill(BITMAP_WORD_BITS // 4)
+                       for word in text.split()) or '0', 16)
+
+
+def sysfs_keys(device_file):
+    """Return the key bitmap of the device according to sysfs, or None if it
+    can't be read"""
+    name = os.path.basename(device_file)
+    path = os.path.join(SYSFS_INPUT, name, 'device', 'capabilities', 'key')
+    try:
+        with open(path) as f:
+            return parse_bitmap(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def has_any_key(bitmap, keys):
+    return any(bitmap >> key & 1 for key in keys)
+
+
+def probe_device(device_file, keymap, all_keys):
+    """Open the device if it may have keys bound in the keymap, and check that
+    it can be grabbed. Returns the device, or None if it has no bound keys,
+    whether it is accessible, and its capabilities if it is. Devices that
+    sysfs says have none of all_keys, the keys bound for any device, are not
+    opened."""
+    bitmap = sysfs_keys(device_file)
+    if bitmap is not None and not has_any_key(bitmap, all_keys):
+        return None, False, None
+    device = evdev.InputDevice(device_file)
+    capabilities = None
+    if bitmap is None:
+        # No sysfs, ask the device itself:
+        capabilities = device.capabilities()
+        bitmap = sum(1 << key for key in set(capabilities.get(ev.EV_KEY, [])))
+    bindings = keymap.bindings(keymap.profile_names(device))
+    if not has_any_key(bitmap, bindings):
+        device.close()
+        return None, False, None
+    try:
+        device.grab()
+        device.ungrab()
+    except OSError:
+        return device, False, None
+    if capabilities is None:
+        capabilities = device.capabilities()
+    return device, True, capabilities
+
+
+def get_mediakey_devices(keymap):
+    """Find all input devices that have any of the keys bound for them in the
+    given keymap.KeyMap. Devices are probed concurrently, and reported in the
+    order evdev lists them. Returns the devices and their merged capabilities,
+    as returned by all_capabilities()."""
     devices = []
+    capabilities = []
     print('  Capturing media keys from:')
-    for device_file in evdev.list_devices():
-        device = evdev.InputDevice(device_file)
-        keys = set(device.capabilities().get(ev.EV_KEY, []))
-        if keys.intersection(MEDIA_KEYS):
-            try:
-                device.grab()
-                device.ungrab()
-            except OSError:
-                print(f'    [IGNORING] {longname(device)} (not accessible)')
-            else:
-                print(f'    {longname(device)}')
-                devices.append(device)
+    probe = partial(probe_device, keymap=keymap, all_keys=keymap.all_keys())
+    with ThreadPoolExecutor(max_workers=MAX_DEVICE_THREADS) as pool:
+        results = list(pool.map(probe, evdev.list_devices()))
+    for device, accessible, device_capabilities in results:
+        if device is None:
+            continue
+        if accessible:
+            print(f'    {longname(device)}')
+            devices.append(device)
+            capabilities.append(device_capabilities)
+        else:
+            print(f'    [IGNORING] {longname(device)} (not accessible)')
+            device.close()
     if not devices:
         print('    <no devices with media keys found>')
-    return devices
+    return devices, all_capabilities(capabilities)
+
+
+def try_grab(device):
+    """Grab the device, returning the exception raised if this fails"""
+    try:
+        device.grab()
+    except OSError as e:
+        return e
+    return None
 
 
 class grab_all(object):
     """Context manager to grab all input from the devices, preventing other
-    applications from getting events."""
+    applications from getting events. Devices are grabbed concurrently, and if
+    any can't be, those that were are ungrabbed and the error raised."""
     def __init__(self, devices):
         self.devices = devices
         self.grabbed = []
 
     def __enter__(self):
-        for dev in self.devices:
-            dev.grab()
-            self.grabbed.append(dev)
+        with ThreadPoolExecutor(max_workers=MAX_DEVICE_THREADS) as pool:
+            errors = list(pool.map(try_grab, self.devices))
+        for dev, error in zip(self.devices, errors):
+            if error is None:
+                self.grabbed.append(dev)
+        for error in errors:
+            if error is not None:
+                self.__exit__()
+                raise error
+        return self
 
     def __exit__(self, *args):
         while self.grabbed:
             dev = self.grabbed.pop()
-            dev.ungrab()
+            try:
+                dev.ungrab()
+            except OSError:
+                # Device removed, and so not grabbed anymore
+                pass
 
 
-def all_capabilities(devices):
+def all_capabilities(capabilities):
+    """Merge a list of devices' capabilities into one dictionary"""
     all_capabilities = defaultdict(set)
-    # Merge the capabilities of all devices into one dictionary.
-    for dev in devices:
-        for ev_type, ev_codes in dev.capabilities().items():
+    for device_capabilities in capabilities:
+        for ev_type, ev_codes in device_capabilities.items():
             all_capabilities[ev_type].update(ev_codes)
     for evtype in (ev.EV_SYN, ev.EV_FF):
         if evtype in all_capabilities:
@@ -125,65 +827,271 @@ def all_capabilities(devices):
 
 
 class KeyRedirection(object):
-    def __init__(self):
+    def __init__(self, trace=None, timings=None, kodi_mode=ACTION_MODE,
+                 keymap_file=KEYMAP_FILE, targets=DEFAULT_TARGETS):
+        """If trace is a latency.LatencyTrace, the latency of each event sent to
+        Kodi or written to uinput is recorded in it. The time spent in each
+        phase of setup is recorded in timings, a timings.Timings instance, if
+        given. kodi_mode is the mode of the KodiClient. Key bindings are read
+        from keymap_file, if it exists, as described in keymap.py. Key events
+        are sent to the Kodi eventservers at targets, a list of (host, port)
+        pairs."""
+        self.trace = trace
+        self.kodi_mode = kodi_mode
+        self.keymap_file = keymap_file
+        self.targets = targets
+        self.timings = timings if timings is not None else Timings()
+        self.error = None
         self.thread = None
         self.stop_fd_reader = None
         self.stop_fd_writer = None
         self.running = False
         self.ready = Event()
+        self.selector = None
+        self.loop = None
+        self.loop_devices = None
+        self.exit_stack = None
+        self.kodi_client = None
+        # Counters, each only updated by the thread or event loop reading the
+        # devices, and read without a lock by metrics(). Events read by device
+        # file, and their devices' names:
+        self.n_events_read = defaultdict(int)
+        self.device_names = {}
+        self.n_dispatched = 0
+        self.n_forwarded = 0
+        self.n_wakeups = 0
+        self.n_devices_removed = 0
 
-    def start(self):
+    def start(self, loop=None):
+        """Start capturing keys. If loop, an asyncio event loop, is given,
+        events are read and dispatched in callbacks on it. Otherwise this is
+        done in a thread."""
         print('Initiating key capturing')
+        if loop is not None:
+            self.start_on_loop(loop)
+        else:
+            self.start_thread()
+        print('Key capturing setup complete\n')
+        self.running = True
+
+    def start_thread(self):
         self.stop_fd_reader, self.stop_fd_writer = os.pipe()
         self.thread = Thread(target=self.mainloop)
         self.thread.start()
         self.ready.wait()
-        print('Key capturing setup complete\n')
-        self.running = True
+        if self.error is not None:
+            self.thread.join()
+            self.thread = None
+            os.close(self.stop_fd_writer)
+            os.close(self.stop_fd_reader)
+            self.stop_fd_reader = self.stop_fd_writer = None
+            raise RuntimeError('Key capturing setup failed') from self.error
+
+    def start_on_loop(self, loop):
+        """Set up, then read the devices in callbacks on the loop. May be
+        called from a thread other than the loop's, so that the loop is not
+        blocked whilst setting up"""
+        self.exit_stack = ExitStack()
+        try:
+            devices, kodi_client, frames = self.setup(self.exit_stack)
+        except Exception:
+            self.exit_stack.close()
+            self.exit_stack = None
+            raise
+        self.loop = loop
+        self.loop_devices = list(devices)
+        loop.call_soon_threadsafe(self.add_readers, kodi_client, frames)
+
+    def add_readers(self, kodi_client, frames):
+        if self.loop is None:
+            # Stopped already
+            return
+        for device in self.loop_devices:
+            self.loop.add_reader(device.fd, self.read_device, device,
+                                 kodi_client, frames)
 
     def stop(self):
         print('Stopping key capturing')
-        os.write(self.stop_fd_writer, b'stop')
-        os.close(self.stop_fd_writer)
-        self.stop_fd_writer = None
-        self.thread.join()
-        self.thread = None
+        if self.loop is not None:
+            for device in self.loop_devices:
+                self.loop.remove_reader(device.fd)
+            self.exit_stack.close()
+            self.exit_stack = None
+            self.loop = None
+            self.loop_devices = None
+        else:
+            os.write(self.stop_fd_writer, b'stop')
+            os.close(self.stop_fd_writer)
+            self.stop_fd_writer = None
+            self.thread.join()
+            self.thread = None
         self.running = False
         print('Key capturing stopped\n')
 
+    def metrics(self):
+        """Return a list of metrics.Metric of the events read and where they
+        were sent"""
+        events_read = [({'device': fn, 'name': self.device_names.get(fn, '')}, n)
+                       for fn, n in sorted(dict(self.n_events_read).items())]
+        metrics = [
+            Metric('events_read_total', 'Input events read from the device',
+                   COUNTER, events_read),
+            Metric('events_dispatched_total', 'Input events handled by kodi',
+                   COUNTER, [({}, self.n_dispatched)]),
+            Metric('events_forwarded_total', 'Input events written to uinput',
+                   COUNTER, [({}, self.n_forwarded)]),
+            Metric('wakeups_total', 'Times woken to read from input devices',
+                   COUNTER, [({}, self.n_wakeups)]),
+            Metric('devices_removed_total', 'Input devices that went away',
+                   COUNTER, [({}, self.n_devices_removed)]),
+        ]
+        if self.kodi_client is not None:
+            metrics.extend(self.kodi_client.metrics())
+        return metrics
+
+    def setup(self, stack):
+        """Find and grab devices with media keys and create the uinput device,
+        registering their cleanup with stack, a contextlib.ExitStack. Returns
+        the devices, and the KodiClient and FrameWriter to send their events
+        to."""
+        phase = self.timings.phase
+        keymap = load_keymap(DEFAULT_BINDINGS, self.keymap_file)
+        kodi_client = stack.enter_context(
+            KodiClient(self.targets, keymap=keymap, trace=self.trace,
+                       mode=self.kodi_mode))
+        with phase('keys: find devices'):
+            devices, capabilities = get_mediakey_devices(keymap)
+        self.kodi_client = kodi_client
+        for device in devices:
+            # So that devices appear in metrics() before sending any events:
+            self.n_events_read.setdefault(device.fn, 0)
+            self.device_names[device.fn] = device.name
+        # Compile each device's dispatch table now, so that invalid bindings
+        # fail setup instead of reading events:
+        with phase('keys: compile dispatch tables'):
+            for device in devices:
+                kodi_client.dispatch_table(device)
+        grabber = grab_all(devices)
+        # Grab the devices whilst creating the uinput device, since neither
+        # needs the other. Leaving the pool waits for the grabs to finish, so
+        # if either fails, the grabs that succeeded are undone by the stack.
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            grabbing = pool.submit(self.grab, grabber)
+            stack.push(grabber)
+            with phase('keys: create uinput device'):
+                ui = stack.enter_context(
+                    evdev.UInput(capabilities, name='DElauncher4Kodi-uinput'))
+            grabbing.result()
+        return devices, kodi_client, FrameWriter(ui, trace=self.trace)
+
+    def grab(self, grabber):
+        with self.timings.phase('keys: grab devices'):
+            grabber.__enter__()
+
+    def read_device(self, device, kodi_client, frames):
+        """Event loop callback dispatching events from a readable device, in
+        the same way as redirect()"""
+        self.n_wakeups += 1
+        try:
+            events = list(device.read())
+        except BlockingIOError:
+            return
+        except OSError:
+            # Device likely removed.
+            if not os.path.exists(device.fn):
+                print(f'[REMOVED] {longname(device)}')
+                self.n_devices_removed += 1
+                self.loop.remove_reader(device.fd)
+                self.loop_devices.remove(device)
+                os.close(device.fd)
+            return
+        self.dispatch(device, events, kodi_client, frames)
+
     def mainloop(self):
-        kodi_client = KodiClient(HOST, PORT)
-        devices = get_mediakey_devices()
-        with grab_all(devices):
-            capabilities = all_capabilities(devices)
-            with evdev.UInput(capabilities, name='DElauncher4Kodi-uinput') as ui:
+
+        try:
+            with ExitStack() as stack:
+                devices, kodi_client, frames = self.setup(stack)
                 self.ready.set()
-                for event in self.read_events(devices):
-                    if not kodi_client.handle_event(event):
-                        ui.write_event(event)
-                        ui.syn()
+                self.redirect(devices, kodi_client, frames)
+        except Exception as e:
+            # Errors during setup are raised in start(), afterwards there is
+            # nobody waiting on us to raise them to:
+            if self.ready.is_set():
+                raise
+            self.error = e
+        finally:
+            self.ready.set()
+
+    def redirect(self, devices, kodi_client, frames):
+        """Send events from the devices to kodi_client, or to frames if
+        kodi_client's dispatch table for the device does not claim them, until
+        stopped"""
+        for device, events in self.read_events(devices):
+            self.dispatch(device, events, kodi_client, frames)
+
+    def dispatch(self, device, events, kodi_client, frames):
+        """Send a batch of events read from the device to kodi_client, or to
+        frames if the device's dispatch table does not claim them, and count
+        them"""
+        table = kodi_client.dispatch_table(device)
+        n_dispatched = 0
+        for event in events:
+            handler = table[event.type * KEY_CNT + event.code]
+            if handler is None:
+                frames.write_event(device.fd, event)
+            else:
+                n_dispatched += 1
+                handler(event)
+        self.n_events_read[device.fn] += len(events)
+        self.n_dispatched += n_dispatched
+        self.n_forwarded += len(events) - n_dispatched
+
+    def add_device(self, device):
+        """Start reading events from the device in read_events()"""
+        self.selector.register(device.fd, selectors.EVENT_READ, device)
+
+    def remove_device(self, device):
+        """Stop reading events from the device in read_events() and close it"""
+        self.selector.unregister(device.fd)
+        os.close(device.fd)
 
     def read_events(self, devices):
-        """Generator yielding event objects from device files. Raises StopIteration
-        if there is data available for read on stop_fd"""
-        devices_by_fd = {device.fd:  device for device in devices}
-        fds = list(devices_by_fd) + [self.stop_fd_reader]
-        while True:
-            r, _, _ = select(fds, [], [], 1.0)
-            if self.stop_fd_reader in r:
-                os.read(self.stop_fd_reader, 1024)
-                os.close(self.stop_fd_reader)
-                self.stop_fd_reader = None
-                return
-            for fd in r:
-                try:
-                    for event in devices_by_fd[fd].read():
-                        yield event
-                except OSError:
-                    # Device likely removed.
-                    device = devices_by_fd[fd]
-                    if not os.path.exists(device.fn):
-                        print(f'[REMOVED] {longname(device)}')
-                        fds.remove(fd)
-                        os.close(fd)
-                        del devices_by_fd[fd]
+        """Generator yielding (device, events) for each read of a list of event
+        objects from the devices. Raises StopIteration if there is data
+        available for read on stop_fd. There is no timeout, the process is
+        only woken when a device or stop_fd is readable."""
+        self.selector = selectors.DefaultSelector()
+        try:
+            # The stop pipe is registered with data=None to tell it apart from
+            # the devices:
+            self.selector.register(self.stop_fd_reader, selectors.EVENT_READ)
+            for device in devices:
+                self.add_device(device)
+            while True:
+                ready = self.selector.select()
+                self.n_wakeups += 1
+                for key, _ in ready:
+                    device = key.data
+                    if device is None:
+                        os.read(self.stop_fd_reader, 1024)
+                        os.close(self.stop_fd_reader)
+                        self.stop_fd_reader = None
+                        return
+                    try:
+                        # A single read() drains all pending events from the
+                        # device, up to the size of evdev's read buffer:
+                        events = list(device.read())
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        # Device likely removed.
+                        if not os.path.exists(device.fn):
+                            print(f'[REMOVED] {longname(device)}')
+                            self.n_devices_removed += 1
+                            self.remove_device(device)
+                        continue
+                    yield device, events
+        finally:
+            self.selector.close()
+            self.selector = None
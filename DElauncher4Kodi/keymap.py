@@ -0,0 +1,224 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Key maps saying what is sent to Kodi for each key of each input device.
+
+Key maps are read from an INI file. Each option is a key name from
+linux/input-event-codes.h, such as KEY_MUTE, or a key code number, bound to
+one of:
+
+    action <name>            a Kodi action, such as VolumeUp
+    button [<map>] <name>    a Kodi button, in the R1 (remote) map by default
+    builtin <command>        a Kodi builtin function, such as ActivateWindow(Home)
+    none                     nothing, the key is passed through as normal
+
+Bindings in the [all] section apply to all devices, in addition to the
+built-in bindings of media keys. Bindings in [id: <vendor>:<product>]
+sections, with the IDs in hex, and then in [name: <device name>] sections,
+apply to matching devices, overriding those of [all]. For example:
+
+    [all]
+    KEY_HOMEPAGE = builtin ActivateWindow(Home)
+
+    [id: 046d:c52b]
+    KEY_RED = button red
+
+    [name: HP Remote Control]
+    KEY_PLAY = action PlayPause
+    KEY_F13 = none
+
+How autorepeats of held keys bound to each action are sent to Kodi is set in
+the [repeat] section, by action name, as any of initial_rate, max_rate (in
+Hz), ramp (in seconds) and curve, overriding those of the built-in policy for
+the action, or as none for no repeats. The 'default' entry applies to actions
+without their own. For example:
+
+    [repeat]
+    VolumeUp = max_rate=30 ramp=3
+    SkipNext = none
+    default = initial_rate=4 max_rate=8
+"""
+
+import os
+import configparser
+from collections import namedtuple
+import evdev.ecodes as ev
+
+KEYMAP_FILE = os.path.join(
+    os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')),
+    'DElauncher4Kodi', 'keymap.ini')
+
+# Kinds of bindings:
+ACTION = 'action'
+BUTTON = 'button'
+BUILTIN = 'builtin'
+NONE = 'none'
+
+DEFAULT_BUTTON_MAP = 'R1'
+
+ALL_SECTION = 'all'
+REPEAT_SECTION = 'repeat'
+# Parameters of key_redirection.RepeatPolicy that can be set:
+REPEAT_PARAMETERS = ('initial_rate', 'max_rate', 'ramp', 'curve')
+ID_PREFIX = 'id:'
+NAME_PREFIX = 'name:'
+
+# What a key is bound to. button_map is None except for buttons:
+Binding = namedtuple('Binding', ['kind', 'name', 'button_map'])
+
+
+def parse_key(name):
+    """Return the key code of a key name or number"""
+    if name.isdigit():
+        code = int(name)
+    else:
+        code = ev.ecodes.get(name.upper())
+    if code is None or not 0 <= code <= ev.KEY_MAX:
+        raise ValueError(f'Unknown key {name!r}')
+    return code
+
+
+def parse_binding(value):
+    """Return the Binding of a key map value, or None if it is 'none'"""
+    kind, _, rest = value.strip().partition(' ')
+    rest = rest.strip()
+    if kind == NONE and not rest:
+        return None
+    if kind in (ACTION, BUILTIN) and rest:
+        return Binding(kind, rest, None)
+    if kind == BUTTON and rest:
+        args = rest.split()
+        if len(args) == 1:
+            return Binding(BUTTON, args[0], DEFAULT_BUTTON_MAP)
+        if len(args) == 2:
+            return Binding(BUTTON, args[1], args[0])
+    raise ValueError(f'Invalid binding {value!r}')
+
+
+def parse_repeat(value):
+    """Return a dict of the RepeatPolicy parameters of a [repeat] section
+    value, or None if it is 'none'"""
+    if value.strip() == NONE:
+        return None
+    params = {}
+    for item in value.split():
+        name, sep, number = item.partition('=')
+        if not sep or name not in REPEAT_PARAMETERS:
+            raise ValueError(f'Invalid repeat parameter {item!r}')
+        try:
+            params[name] = float(number)
+        except ValueError:
+            raise ValueError(f'Invalid repeat parameter {item!r}') from None
+        if params[name] < 0 or (name == 'initial_rate' and not params[name]):
+            raise ValueError(f'Repeat parameter out of range {item!r}')
+    if not params:
+        raise ValueError(f'Invalid repeat policy {value!r}')
+    return params
+
+
+def id_section(vendor, product):
+    return f'{ID_PREFIX} {vendor:04x}:{product:04x}'
+
+
+def name_section(name):
+    return f'{NAME_PREFIX} {name}'
+
+
+def normalise_section(section):
+    """Return the section name in the form that devices are matched against"""
+    if section.startswith(ID_PREFIX):
+        vendor, sep, product = section[len(ID_PREFIX):].strip().partition(':')
+        try:
+            return id_section(int(vendor, 16), int(product, 16))
+        except ValueError:
+            pass
+        raise ValueError(f'Invalid device IDs in section [{section}]')
+    if section.startswith(NAME_PREFIX):
+        return name_section(section[len(NAME_PREFIX):].strip())
+    if section in (ALL_SECTION, REPEAT_SECTION):
+        return section
+    raise ValueError(f'Unknown section [{section}]')
+
+
+class KeyMap(object):
+    def __init__(self, defaults, profiles=None, repeat=None):
+        """defaults is a dict of key code: Binding for all devices. profiles
+        is a dict of section name, as returned by id_section() or
+        name_section(): dict of key code: Binding, or None to unbind the key,
+        for matching devices. repeat is a dict of action name: dict of
+        RepeatPolicy parameters, or None for no repeats."""
+        self.defaults = defaults
+        self.profiles = profiles if profiles is not None else {}
+        self.repeat = repeat if repeat is not None else {}
+
+    def profile_names(self, device):
+        """Return the names of the profiles that apply to the device, in order
+        of increasing precedence"""
+        info = device.info
+        names = [id_section(info.vendor, info.product), name_section(device.name)]
+        return tuple(name for name in names if name in self.profiles)
+
+    def bindings(self, profile_names=()):
+        """Return a dict of key code: Binding of the keys bound in the defaults
+        as overridden by the given profiles"""
+        bindings = dict(self.defaults)
+        for name in profile_names:
+            bindings.update(self.profiles[name])
+        return {key: b for key, b in bindings.items() if b is not None}
+
+    def all_keys(self):
+        """Return the set of keys bound for any device"""
+        keys = set(self.bindings())
+        for profile in self.profiles.values():
+            keys.update(key for key, b in profile.items() if b is not None)
+        return keys
+
+
+def load_keymap(defaults, path=KEYMAP_FILE):
+    """Return a KeyMap of the built-in defaults, a dict of key code: Binding,
+    and the bindings in the file at path, if it exists. Raises ValueError if
+    the file is invalid."""
+    if not os.path.exists(path):
+        return KeyMap(defaults)
+    parser = configparser.ConfigParser(delimiters=('=',), interpolation=None)
+    # Key names are case sensitive:
+    parser.optionxform = str
+    try:
+        parser.read(path)
+        defaults = dict(defaults)
+        profiles = {}
+        repeat = {}
+        for section in parser.sections():
+            if section == REPEAT_SECTION:
+                try:
+                    repeat.update((action, parse_repeat(value))
+                                  for action, value in parser.items(section))
+                except ValueError as e:
+                    raise ValueError(f'{e} in section [{section}]') from None
+                continue
+            try:
+                bindings = {parse_key(key): parse_binding(value)
+                            for key, value in parser.items(section)}
+            except ValueError as e:
+                raise ValueError(f'{e} in section [{section}]') from None
+            name = normalise_section(section)
+            if name == ALL_SECTION:
+                defaults.update(bindings)
+            else:
+                profiles.setdefault(name, {}).update(bindings)
+    except (ValueError, configparser.Error) as e:
+        raise ValueError(f'Error reading key map {path}: {e}') from None
+    return KeyMap(defaults, profiles, repeat)
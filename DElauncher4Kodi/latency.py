@@ -0,0 +1,84 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+from array import array
+
+# Number of most recent samples kept for each path:
+RING_SIZE = 65536
+
+# Upper edges of histogram bins, in milliseconds:
+BIN_EDGES = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250]
+BAR_WIDTH = 40
+
+
+class LatencyRing(object):
+    """Ring buffer of latencies between the kernel timestamp of an input event
+    and the moment it was sent on. The buffer is allocated up front, recording
+    a sample only overwrites an entry of it."""
+    def __init__(self, name, size=RING_SIZE):
+        self.name = name
+        self.size = size
+        self.samples = array('d', bytes(8 * size))
+        self.count = 0
+
+    def record(self, event):
+        # evdev timestamps are CLOCK_REALTIME, same as time.time():
+        latency = time.time() - event.sec - event.usec * 1e-6
+        self.samples[self.count % self.size] = latency
+        self.count += 1
+
+    def report(self):
+        print(f'  {self.name}:')
+        n_samples = min(self.count, self.size)
+        if not n_samples:
+            print('    <no events>')
+            return
+        samples = sorted(self.samples[:n_samples])
+        if self.count > self.size:
+            print(f'    {self.count} events, statistics of last {self.size}')
+        else:
+            print(f'    {self.count} events')
+        percentiles = []
+        for name, fraction in [('p50', 0.50), ('p95', 0.95), ('p99', 0.99)]:
+            value = samples[min(int(fraction * n_samples), n_samples - 1)]
+            percentiles.append(f'{name}: {value * 1e3:.3f} ms')
+        percentiles.append(f'max: {samples[-1] * 1e3:.3f} ms')
+        print('    ' + ', '.join(percentiles))
+        counts = [0] * (len(BIN_EDGES) + 1)
+        for latency in samples:
+            bin_index = 0
+            while bin_index < len(BIN_EDGES) and latency * 1e3 > BIN_EDGES[bin_index]:
+                bin_index += 1
+            counts[bin_index] += 1
+        labels = [f'<= {edge} ms' for edge in BIN_EDGES] + [f'> {BIN_EDGES[-1]} ms']
+        for label, count in zip(labels, counts):
+            bar = '#' * round(BAR_WIDTH * count / n_samples)
+            print(f'    {label:>12} {count:8d} {bar}')
+
+
+class LatencyTrace(object):
+    """Latencies of input events, split by whether they were sent to Kodi as an
+    action or forwarded to uinput"""
+    def __init__(self, size=RING_SIZE):
+        self.kodi = LatencyRing('Kodi action', size)
+        self.uinput = LatencyRing('uinput passthrough', size)
+
+    def report(self):
+        print('Input latency (kernel timestamp to send):')
+        self.kodi.report()
+        self.uinput.report()
+        print()
@@ -0,0 +1,156 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Runtime counters served as a snapshot on a Unix domain socket.
+
+Each connection to the socket gets a snapshot of the counters in the
+Prometheus text exposition format, and is then closed. If the client sends an
+HTTP request first, such as with
+
+    curl --unix-socket /tmp/DElauncher4Kodi.metrics http://localhost/metrics
+
+the snapshot is sent as an HTTP response, so that it can be scraped through a
+proxy forwarding to the socket. Otherwise, as with
+
+    socat - UNIX-CONNECT:/tmp/DElauncher4Kodi.metrics
+
+it is sent as is."""
+
+import os
+import selectors
+from socket import socket, AF_UNIX, SOCK_STREAM, timeout as SocketTimeout
+from threading import Thread
+from collections import namedtuple
+
+METRICS_SOCKET = '/tmp/DElauncher4Kodi.metrics'
+PREFIX = 'delauncher4kodi_'
+COUNTER = 'counter'
+GAUGE = 'gauge'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# How long to wait for a client to send an HTTP request, seconds:
+REQUEST_TIMEOUT = 0.2
+MAX_REQUEST_SIZE = 8192
+
+# A metric, without PREFIX, and its (labels dict, value) samples:
+Metric = namedtuple('Metric', ['name', 'help', 'type', 'samples'])
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def render(metrics):
+    """Return the metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in metrics:
+        name = PREFIX + metric.name
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        for labels, value in metric.samples:
+            if labels:
+                labels = ','.join(f'{k}="{escape(v)}"'
+                                  for k, v in labels.items())
+                lines.append(f'{name}{{{labels}}} {value}')
+            else:
+                lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def read_request(conn):
+    """Return the HTTP request headers sent on the connection, or b'' if the
+    client sends none"""
+    conn.settimeout(REQUEST_TIMEOUT)
+    request = b''
+    try:
+        while b'\r\n\r\n' not in request and len(request) < MAX_REQUEST_SIZE:
+            data = conn.recv(1024)
+            if not data:
+                break
+            request += data
+    except SocketTimeout:
+        pass
+    return request
+
+
+class MetricsServer(object):
+    def __init__(self, collect, path=METRICS_SOCKET):
+        """Serve render(collect()) to each client connecting to a Unix socket
+        at path. collect is called in the server's thread, so must only read
+        the counters."""
+        self.collect = collect
+        self.path = path
+        self.sock = None
+        self.thread = None
+        self.stop_fd_reader = None
+        self.stop_fd_writer = None
+        self.n_scrapes = 0
+
+    def start(self):
+        # Any socket file at the path is left over from an instance that was
+        # killed, since the caller holds the lock:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen()
+        self.stop_fd_reader, self.stop_fd_writer = os.pipe()
+        self.thread = Thread(target=self.mainloop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.stop_fd_writer, b'stop')
+        self.thread.join()
+        self.thread = None
+        os.close(self.stop_fd_writer)
+        os.close(self.stop_fd_reader)
+        self.stop_fd_reader = self.stop_fd_writer = None
+        self.sock.close()
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def mainloop(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.stop_fd_reader, selectors.EVENT_READ)
+            selector.register(self.sock, selectors.EVENT_READ)
+            while True:
+                for key, _ in selector.select():
+                    if key.fileobj == self.stop_fd_reader:
+                        return
+                    conn, _ = self.sock.accept()
+                    with conn:
+                        try:
+                            self.serve(conn)
+                        except OSError:
+                            # Client went away
+                            pass
+
+    def serve(self, conn):
+        self.n_scrapes += 1
+        request = read_request(conn)
+        body = render(self.collect()).encode()
+        if request.startswith(b'GET '):
+            headers = ('HTTP/1.0 200 OK\r\n' +
+                       f'Content-Type: {CONTENT_TYPE}\r\n' +
+                       f'Content-Length: {len(body)}\r\n\r\n')
+            body = headers.encode() + body
+        conn.sendall(body)
@@ -0,0 +1,56 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+from contextlib import contextmanager
+
+
+class Timings(object):
+    """Record the start and end times of named phases, relative to the
+    creation of this object. Phases may be recorded from multiple threads."""
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic() - self.start_time
+        try:
+            yield
+        finally:
+            end = time.monotonic() - self.start_time
+            self.phases.append((name, start, end))
+
+    def duration(self, name):
+        """Return the total time spent in phases with the given name"""
+        return sum(end - start for phase, start, end in self.phases
+                   if phase == name)
+
+    def report(self):
+        print('Timings (seconds since launch):')
+        print(f'  {"start":>7} {"end":>7} {"duration":>8}  phase')
+        for name, start, end in sorted(self.phases, key=lambda p: p[1:]):
+            print(f'  {start:7.3f} {end:7.3f} {end - start:8.3f}  {name}')
+        startup = [p for p in self.phases if p[0].startswith('startup: ')]
+        if startup:
+            name, start, end = max(startup, key=lambda p: p[2])
+            print(f'  Startup critical path: {name}, complete at {end:.3f}')
+        shutdown = [p for p in self.phases if p[0].startswith('shutdown: ')]
+        if shutdown:
+            start = min(p[1] for p in shutdown)
+            end = max(p[2] for p in shutdown)
+            print(f'  Shutdown took {end - start:.3f}')
+        print()
@@ -14,26 +14,153 @@
 #   with this program; if not, write to the Free Software Foundation, Inc.,
 #   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from subprocess import check_output, check_call
+import sys
 import pulsectl
-from threading import Thread
-import time
+from threading import Thread, Event, Lock, RLock
+from contextlib import contextmanager
+
+from .timings import Timings
+from .metrics import Metric, COUNTER
 
 NULL_SINK_NAME = "DElauncher4Kodi.nullsink"
 CLIENT_NAME = 'DElauncher4Kodi'
 
+# How long to wait for the server to report the null sink removed, seconds:
+SINK_REMOVAL_TIMEOUT = 1.0
+
+# Delay before the first and longest delay between attempts to reconnect to
+# the server from the waiter thread, seconds:
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+
+class CountingPulse(pulsectl.Pulse):
+    """pulsectl.Pulse counting the operations it waits on the server for, in
+    the PulseConnection it belongs to. Each is a round trip, except for those
+    pipelined by move_streams()."""
+    def __init__(self, client_name, connection):
+        self.connection = connection
+        super().__init__(client_name)
+
+    @contextmanager
+    def _pulse_op_cb(self, raw=False):
+        self.connection.n_operations += 1
+        with super()._pulse_op_cb(raw=raw) as cb:
+            yield cb
+
+
+class PulseConnection(object):
+    """A long-lived connection to the PulseAudio server shared between threads.
+
+    Pulse calls must be made within the use() context manager, which gives
+    one thread at a time access to the connection. A thread may wait for
+    events with listen(), and use() from another thread interrupts it. If the
+    server goes away, the next use() or listen() reconnects, restoring any
+    event subscription made with subscribe(), or raises pulsectl.PulseError
+    if the server cannot be reached. Objects from before a reconnect, such as
+    sink indices, may be stale, callers can compare n_connects to tell."""
+    def __init__(self, client_name):
+        self.client_name = client_name
+        self.pulse = None
+        self.lock = RLock()
+        # Protects self.listening, which is read without holding self.lock:
+        self.state_lock = Lock()
+        self.listening = False
+        self.event_masks = None
+        self.event_filter = None
+        self.event_pending = False
+        # Counters, only updated with self.lock held:
+        self.n_connects = 0
+        self.n_operations = 0
+        self.n_events = 0
 
-def make_null_sink(name):
-    output = check_output(
-        ['pactl', 'load-module', 'module-null-sink',
-         f'sink_name={name}"',
-         f'sink_properties=device.description={name}'])
-    module_id = int(output.strip())
+    def _connect(self):
+        if self.pulse is not None and self.pulse.connected:
+            return self.pulse
+        self.close()
+        pulse = CountingPulse(self.client_name, self)
+        self.n_connects += 1
+        if self.event_masks is not None:
+            pulse.event_mask_set(*self.event_masks)
+            pulse.event_callback_set(self._on_event)
+        self.pulse = pulse
+        return pulse
+
+    def _on_event(self, event):
+        # Called from within pulse calls, so makes none itself:
+        if self.event_filter(event):
+            self.n_events += 1
+            self.event_pending = True
+            if self.listening:
+                raise pulsectl.PulseLoopStop
+
+    @contextmanager
+    def use(self):
+        """Context manager giving exclusive access to the connected
+        pulsectl.Pulse object"""
+        # event_listen_stop() does nothing if the listening thread has not
+        # yet entered event_listen(), so repeat it until we get the lock:
+        while not self.lock.acquire(timeout=0.01):
+            self.interrupt()
+        try:
+            yield self._connect()
+        finally:
+            self.lock.release()
+
+    def subscribe(self, masks, event_filter):
+        """Subscribe to events of the given facility masks. listen() returns
+        once event_filter(event) returns True for an event."""
+        with self.lock:
+            self.event_masks = masks
+            self.event_filter = event_filter
+            # Events matching any previous subscription no longer count:
+            self.event_pending = False
+            if self.pulse is not None and self.pulse.connected:
+                self.pulse.event_mask_set(*masks)
+                self.pulse.event_callback_set(self._on_event)
+
+    def listen(self, timeout=None):
+        """Wait for an event matching the subscription's filter, or for an
+        interruption by interrupt() or use() from another thread, or for
+        timeout seconds if not None. Returns immediately if a matching event
+        arrived since the last call, including during other pulse calls."""
+        with self.lock:
+            pulse = self._connect()
+            if not self.event_pending:
+                with self.state_lock:
+                    self.listening = True
+                try:
+                    pulse.event_listen(timeout=timeout)
+                except pulsectl.PulseDisconnected:
+                    # Reconnect on next use:
+                    pass
+                finally:
+                    with self.state_lock:
+                        self.listening = False
+            self.event_pending = False
+
+    def interrupt(self):
+        """Make a call to listen() in another thread return"""
+        with self.state_lock:
+            if self.listening:
+                self.pulse.event_listen_stop()
+
+    def close(self):
+        with self.lock:
+            if self.pulse is not None:
+                self.pulse.close()
+                self.pulse = None
+
+
+def make_null_sink(pulse, name):
+    module_id = pulse.module_load(
+        'module-null-sink',
+        [f'sink_name={name}"', f'sink_properties=device.description={name}'])
     return module_id
 
 
-def unload_module(module):
-    check_call(['pactl', 'unload-module', str(module)])
+def unload_module(pulse, module):
+    pulse.module_unload(module)
 
 
 def default_sink_info(pulse):
@@ -53,7 +180,7 @@ def default_sink_info(pulse):
 
 def set_null_sink_default(pulse):
     print('  Creating null sink as default sink:')
-    null_sink_module = make_null_sink(NULL_SINK_NAME)
+    null_sink_module = make_null_sink(pulse, NULL_SINK_NAME)
     for sink in pulse.sink_list():
         if sink.owner_module == null_sink_module:
             pulse.default_set(sink)
@@ -63,17 +190,68 @@ def set_null_sink_default(pulse):
     raise RuntimeError("Could not set null sink default")
 
 
+def is_kodi_stream(stream):
+    return 'kodi' in stream.name.lower()
+
+
+def move_streams(pulse, moves):
+    """Move sink inputs to sinks, given a list of (sink input index, sink
+    index) pairs. All moves are sent to the server before waiting for any
+    reply, so that this takes about one round trip regardless of the number of
+    streams. Returns a list of whether each move succeeded."""
+    try:
+        from pulsectl import _pulsectl
+        pa_op_cb = pulse._pulse_op_cb
+        # LibPulse raises KeyError for functions it does not wrap:
+        move_sink_input = _pulsectl.pa.context_move_sink_input_by_index
+    except (ImportError, AttributeError, KeyError):
+        # pulsectl internals not as expected, move streams one by one:
+        return [move_stream(pulse, index, sink) for index, sink in moves]
+    operations = []
+    for index, sink in moves:
+        operation = pa_op_cb()
+        callback = operation.__enter__()
+        try:
+            move_sink_input(pulse._ctx, index, sink, callback, None)
+        except Exception:
+            operation.__exit__(*sys.exc_info())
+            operation = None
+        operations.append(operation)
+    results = []
+    for operation in operations:
+        if operation is None:
+            results.append(False)
+            continue
+        # Waits for the reply:
+        try:
+            operation.__exit__(None, None, None)
+        except pulsectl.PulseOperationFailed:
+            results.append(False)
+        else:
+            results.append(True)
+    return results
+
+
+def move_stream(pulse, index, sink):
+    try:
+        pulse.sink_input_move(index, sink)
+    except pulsectl.PulseOperationFailed:
+        return False
+    return True
+
+
 def move_all_streams_to_sink(pulse, target_sink):
     print('  Moving exising audio streams to null sink:')
+    # Kodi may already be running, its stream is moved by wait_thread:
+    streams = [s for s in pulse.sink_input_list() if not is_kodi_stream(s)]
+    sinks = [s.sink for s in streams]
+    moved = move_streams(pulse, [(s.index, target_sink.index) for s in streams])
     orig_sinks = {}
-    for stream in pulse.sink_input_list():
-        orig_sinks[stream] = stream.sink
-        try:
-            pulse.sink_input_move(stream.index, target_sink.index)
+    for stream, sink, success in zip(streams, sinks, moved):
+        # If not successful, stream probably doesn't exist anymore
+        if success:
+            orig_sinks[stream] = sink
             print(f'    {stream.name}')
-        except pulsectl.PulseOperationFailed:
-            # Stream probably doesn't exist anymore
-            del orig_sinks[stream]
     if not orig_sinks:
         print('    <no streams found>')
     return orig_sinks
@@ -81,18 +259,74 @@ def move_all_streams_to_sink(pulse, target_sink):
 
 def restore_streams(pulse, orig_sinks):
     print('  Moving streams back to default sink:')
-    for stream, sink in orig_sinks.items():
-        try:
-            pulse.sink_input_move(stream.index, sink)
+    streams = list(orig_sinks)
+    moved = move_streams(pulse, [(s.index, orig_sinks[s]) for s in streams])
+    for stream, success in zip(streams, moved):
+        if success:
             print(f'    {stream.name}')
-        except pulsectl.PulseOperationFailed:
+        else:
             print(f'    [IGNORED] {stream.name} (no longer present)')
     if not orig_sinks:
         print('    <no streams to restore>')
 
 
+def find_sink(pulse, name):
+    for sink in pulse.sink_list():
+        if sink.name == name:
+            return sink
+    return None
+
+
+def unload_null_sinks(pulse, module):
+    """Unload the given null sink module, if loaded, and any other null sinks
+    of ours, such as one loaded before the journal recorded it. Returns the
+    number unloaded"""
+    n_unloaded = 0
+    for m in pulse.module_list():
+        if m.name != 'module-null-sink':
+            continue
+        ours = f'sink_name={NULL_SINK_NAME}' in (m.argument or '')
+        if m.index == module or ours:
+            try:
+                unload_module(pulse, m.index)
+            except pulsectl.PulseOperationFailed:
+                continue
+            n_unloaded += 1
+    return n_unloaded
+
+
+def recover(state):
+    """Restore the audio configuration recorded in a journal by
+    VolumeAdjustment.start() in a process that did not get to stop()"""
+    print('Recovering audio configuration from journal')
+    with pulsectl.Pulse(CLIENT_NAME) as pulse:
+        sink = find_sink(pulse, state['sink']) if 'sink' in state else None
+        if sink is not None:
+            print(f'  Restoring original default sink {sink.name}')
+            pulse.volume_set_all_chans(sink, 0.000)
+            pulse.default_set(sink)
+        streams = state.get('streams', [])
+        if streams:
+            # Streams that no longer exist fail to move and are ignored:
+            moved = move_streams(pulse, [tuple(move) for move in streams])
+            print(f'  Moved {sum(moved)} of {len(moved)} streams back')
+        n_unloaded = unload_null_sinks(pulse, state.get('null_sink_module'))
+        print(f'  Unloaded {n_unloaded} null sink module(s)')
+        if sink is not None:
+            print('  Restoring original volume')
+            pulse.volume_set_all_chans(sink, state['volume'])
+            pulse.mute(sink, state['mute'])
+    print('Audio configuration recovered\n')
+
+
 class VolumeAdjustment(object):
-    def __init__(self):
+    def __init__(self, timings=None, journal=None):
+        """The time spent in each phase of start and stop is recorded in
+        timings, a timings.Timings instance, if given. What is needed to undo
+        each step of start is recorded in journal, a journal.Journal instance,
+        if given, and the journal cleared once stop is complete."""
+        self.timings = timings if timings is not None else Timings()
+        self.journal = journal
         self.running = False
         self.sink = None
         self.volume = None
@@ -102,34 +336,88 @@ class VolumeAdjustment(object):
         self.orig_streams = None
         self.thread = None
         self.stopping = False
+        self.wake = Event()
+        self.connection = PulseConnection(CLIENT_NAME)
+        # The connection's n_connects when the sinks were last looked up:
+        self.n_connects = 0
+
+    @contextmanager
+    def use(self):
+        """Context manager giving exclusive access to the connected
+        pulsectl.Pulse object, looking up our sinks again if it reconnected
+        since they were last looked up"""
+        with self.connection.use() as pulse:
+            if self.connection.n_connects != self.n_connects:
+                if self.sink is not None:
+                    self.rediscover(pulse)
+                self.n_connects = self.connection.n_connects
+            yield pulse
+
+    def rediscover(self, pulse):
+        """Look up the original default sink and the null sink by name after
+        reconnecting. If the server restarted, their indices have changed, and
+        the null sink and the streams we moved to it are gone."""
+        print('Reconnected to PulseAudio, looking up sinks again')
+        sink = find_sink(pulse, self.sink.name)
+        if sink is not None:
+            self.sink = sink
+        else:
+            print(f'  [IGNORED] original default sink {self.sink.name} gone')
+        if self.null_sink is None:
+            return
+        null_sink = find_sink(pulse, self.null_sink.name)
+        if null_sink is None or null_sink.index != self.null_sink.index:
+            # Sink input indices are not reused within a server's lifetime,
+            # so ours can only be stale if the null sink is:
+            print('  Null sink gone, original streams no longer present')
+            self.orig_streams = {}
+            self.null_sink = null_sink
+            self.null_sink_module = (None if null_sink is None
+                                     else null_sink.owner_module)
+            self.record(null_sink_module=self.null_sink_module, streams=[])
 
     def start(self):
         print('Initiating audio reconfiguration')
-        with pulsectl.Pulse(CLIENT_NAME) as pulse:
-            self.sink, self.volume, self.mute = default_sink_info(pulse)
-            self.null_sink, self.null_sink_module = set_null_sink_default(pulse)
-            self.orig_streams = move_all_streams_to_sink(pulse, self.null_sink)
-            print(r'  Setting original default sink to 100 % volume')
-            pulse.volume_set_all_chans(self.sink, 1.0)
-            pulse.mute(self.sink, 0)
+        phase = self.timings.phase
+        with self.connection.use() as pulse:
+            self.n_connects = self.connection.n_connects
+            with phase('audio: get default sink'):
+                self.sink, self.volume, self.mute = default_sink_info(pulse)
+                self.record(sink=self.sink.name, volume=self.volume,
+                            mute=bool(self.mute))
+            with phase('audio: load null sink'):
+                self.null_sink, self.null_sink_module = set_null_sink_default(pulse)
+                self.record(null_sink_module=self.null_sink_module)
+            with phase('audio: move streams to null sink'):
+                self.orig_streams = move_all_streams_to_sink(pulse, self.null_sink)
+                self.record(streams=[(stream.index, sink) for stream, sink
+                                     in self.orig_streams.items()])
+            with phase('audio: set volume'):
+                print(r'  Setting original default sink to 100 % volume')
+                pulse.volume_set_all_chans(self.sink, 1.0)
+                pulse.mute(self.sink, 0)
         self.thread = Thread(target=self.wait_thread)
         self.thread.start()
         self.running = True
         print('Audio reconfiguration complete pending kodi startup\n')
 
-    def wait_for_kodi(self, pulse):
-        while not self.stopping:
-            time.sleep(0.1)
-            for stream in pulse.sink_input_list():
-                if 'kodi' in stream.name.lower():
-                    return stream
-        return None
+    def record(self, **fields):
+        if self.journal is not None:
+            with self.timings.phase('audio: write journal'):
+                self.journal.update(**fields)
 
-    def wait_thread(self):
-        with pulsectl.Pulse(CLIENT_NAME) as pulse:
-            print('Waiting for kodi audio stream to appear')
-            stream = self.wait_for_kodi(pulse)
-            if stream is not None:
+    def is_new_stream_event(self, event):
+        return event.t == 'new'
+
+    def is_null_sink_removal(self, event):
+        return (event.t == 'remove' and self.null_sink is not None
+                and event.index == self.null_sink.index)
+
+    def move_kodi_streams(self, pulse):
+        """Move any kodi audio streams not already playing on the original
+        default sink to it"""
+        for stream in pulse.sink_input_list():
+            if is_kodi_stream(stream) and stream.sink != self.sink.index:
                 print('  Audio stream has appeared')
                 try:
                     print('  moving kodi audio stream to original default sink')
@@ -137,25 +425,71 @@ class VolumeAdjustment(object):
                 except pulsectl.PulseOperationFailed:
                     pass
 
-    def stop(self):
-        print('Restoring audio configuration')
+    def wait_thread(self):
+        self.connection.subscribe(['sink_input'], self.is_new_stream_event)
+        print('Waiting for kodi audio stream to appear')
+        # Keep watching after kodi's stream has been moved, since kodi
+        # creates a new stream whenever it reinitialises its audio device.
+        delay = RECONNECT_DELAY
+        while not self.stopping:
+            try:
+                with self.use() as pulse:
+                    self.move_kodi_streams(pulse)
+                # Returns immediately if a stream appeared whilst we were
+                # looking:
+                self.connection.listen()
+            except pulsectl.PulseError as e:
+                # Server likely went away, possibly restarting. use() will
+                # reconnect once it is back:
+                print(f'  Lost PulseAudio connection ({e}), ' +
+                      f'retrying in {delay:.1f} s')
+                self.wake.wait(delay)
+                delay = min(2 * delay, MAX_RECONNECT_DELAY)
+            else:
+                delay = RECONNECT_DELAY
+
+    def stop_waiter(self):
         self.stopping = True
+        self.wake.set()
+        # listen() only returns early if it has already been entered, so
+        # repeat the interruption until the waiter has exited:
+        while self.thread.is_alive():
+            self.connection.interrupt()
+            self.thread.join(0.01)
         self.thread.join()
-        with pulsectl.Pulse(CLIENT_NAME) as pulse:
+
+    def stop(self):
+        print('Restoring audio configuration')
+        phase = self.timings.phase
+        with phase('audio: stop waiter'):
+            self.stop_waiter()
+        with self.use() as pulse:
             # Volume to zero, then move streams, then restore actual volume. This
             # helps prevents clicks and pops when moving streams
-            print('  Setting original default sink to 0 % volume')
-            pulse.volume_set_all_chans(self.sink, 0.000)
-            pulse.mute(self.sink, self.mute)
-            print('  Restoring original default sink')
-            pulse.default_set(self.sink)
-            restore_streams(pulse, self.orig_streams)
-            print('  Unloading null sink module')
-            unload_module(self.null_sink_module)
-            time.sleep(0.1)
-            print('  Restoring original volume')
-            pulse.volume_set_all_chans(self.sink, self.volume)
+            with phase('audio: restore default sink'):
+                print('  Setting original default sink to 0 % volume')
+                pulse.volume_set_all_chans(self.sink, 0.000)
+                pulse.mute(self.sink, self.mute)
+                print('  Restoring original default sink')
+                pulse.default_set(self.sink)
+            with phase('audio: restore streams'):
+                restore_streams(pulse, self.orig_streams)
+            with phase('audio: unload null sink'):
+                if self.null_sink_module is not None:
+                    print('  Unloading null sink module')
+                    # Streams still on the null sink are moved to the default
+                    # sink when it is removed, wait for that before raising
+                    # the volume:
+                    self.connection.subscribe(['sink'], self.is_null_sink_removal)
+                    unload_module(pulse, self.null_sink_module)
+                    self.connection.listen(timeout=SINK_REMOVAL_TIMEOUT)
+            with phase('audio: restore volume'):
+                print('  Restoring original volume')
+                pulse.volume_set_all_chans(self.sink, self.volume)
             print('Audio configuration restored\n')
+        self.connection.close()
+        if self.journal is not None:
+            self.journal.clear()
         self.sink = None
         self.volume = None
         self.mute = None
@@ -165,3 +499,27 @@ class VolumeAdjustment(object):
         self.running = False
         self.null_sink_module = None
         self.stopping = False
+        self.wake.clear()
+
+    def metrics(self):
+        """Return a list of metrics.Metric of the PulseAudio connection and
+        the time spent in each phase of start and stop"""
+        durations = {}
+        for name, start, end in list(self.timings.phases):
+            if name.startswith('audio: '):
+                durations[name] = durations.get(name, 0) + end - start
+        connection = self.connection
+        return [
+            Metric('pulse_connects_total', 'Connections made to PulseAudio',
+                   COUNTER, [({}, connection.n_connects)]),
+            Metric('pulse_operations_total',
+                   'Operations waited on PulseAudio for, each a round trip ' +
+                   'unless pipelined', COUNTER,
+                   [({}, connection.n_operations)]),
+            Metric('pulse_events_total', 'PulseAudio events waited for',
+                   COUNTER, [({}, connection.n_events)]),
+            Metric('audio_phase_seconds_total',
+                   'Time spent in each phase of audio reconfiguration',
+                   COUNTER, [({'phase': name[len('audio: '):]}, f'{t:.6f}')
+                             for name, t in sorted(durations.items())]),
+        ]
@@ -45,7 +45,8 @@ __version__ = "0.0.3"
 import sys
 if sys.version_info.major == 2:
     str = unicode
-from struct import pack
+from struct import pack, Struct
+from collections import namedtuple
 from socket import socket, AF_INET,SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST
 import time
 
@@ -54,6 +55,9 @@ HEADER_SIZE      = 32
 MAX_PAYLOAD_SIZE = MAX_PACKET_SIZE - HEADER_SIZE
 UNIQUE_IDENTIFICATION = (int)(time.time())
 
+# H1-H8 of the packet header, see Packet below:
+HEADER = Struct("!4sBBHIIHI10s")
+
 PT_HELO          = 0x01
 PT_BYE           = 0x02
 PT_BUTTON        = 0x03
@@ -143,6 +147,9 @@ class Packet:
          | -P1 payload               | -
          -----------------------------
     """
+    __slots__ = ('sig', 'minver', 'majver', 'seq', 'maxseq', 'payloadsize',
+                 'uid', 'reserved', 'payload', 'packettype')
+
     def __init__(self):
         self.sig = b"XBMC"
         self.minver = 0
@@ -152,7 +159,7 @@ class Packet:
         self.payloadsize = 0
         self.uid = UNIQUE_IDENTIFICATION
         self.reserved = b"\0" * 10
-        self.payload = b""
+        self.payload = bytearray()
         return
 
 
@@ -164,7 +171,8 @@ class Packet:
         """
         if isinstance(blob, str):
             blob = blob.encode()
-        self.set_payload(self.payload + blob)
+        self.payload += blob
+        self._update_payload_size()
 
 
     def set_payload(self, payload):
@@ -175,7 +183,11 @@ class Packet:
         """
         if isinstance(payload, str):
             payload = payload.encode()
-        self.payload = payload
+        self.payload = bytearray(payload)
+        self._update_payload_size()
+
+
+    def _update_payload_size(self):
         self.payloadsize = len(self.payload)
         self.maxseq = int((self.payloadsize + (MAX_PAYLOAD_SIZE - 1)) / MAX_PAYLOAD_SIZE)
 
@@ -199,16 +211,8 @@ class Packet:
         """
         if packettype < 0:
             packettype = self.packettype
-        header = self.sig
-        header += chr(self.majver).encode()
-        header += chr(self.minver).encode()
-        header += format_uint16(packettype)
-        header += format_uint32(seq)
-        header += format_uint32(maxseq)
-        header += format_uint16(payload_size)
-        header += format_uint32(self.uid)
-        header += self.reserved
-        return header
+        return HEADER.pack(self.sig, self.majver, self.minver, packettype,
+                           seq, maxseq, payload_size, self.uid, self.reserved)
 
     def get_payload_size(self, seq):
         """Returns the calculated payload size for the particular packet
@@ -235,18 +239,60 @@ class Packet:
         """
         if packetnum > self.num_packets() or packetnum < 1:
             return b""
-        header = b""
-        if packetnum==1:
-            header = self.get_header(self.packettype, packetnum, self.maxseq,
-                                     self.get_payload_size(packetnum))
+        message = bytearray(HEADER_SIZE + self.get_payload_size(packetnum))
+        self.pack_into(message, 0, packetnum)
+        return bytes(message)
+
+    def pack_into(self, buffer, offset=0, packetnum=1):
+        """Write the UDP message for the specified packetnum into a writable
+        buffer and return the number of bytes written
+
+        Arguments:
+        buffer -- bytearray or writable memoryview to write the message into
+
+        Keyword arguments:
+        offset -- position in the buffer at which to start writing (default 0)
+        packetnum -- the packet no. for which to construct the message
+                     (default 1)
+        """
+        payload_size = self.get_payload_size(packetnum)
+        if packetnum == 1:
+            packettype = self.packettype
         else:
-            header = self.get_header(PT_BLOB, packetnum, self.maxseq,
-                                     self.get_payload_size(packetnum))
+            packettype = PT_BLOB
+        HEADER.pack_into(buffer, offset, self.sig, self.majver, self.minver,
+                         packettype, packetnum, self.maxseq, payload_size,
+                         self.uid, self.reserved)
+        start = (packetnum - 1) * MAX_PAYLOAD_SIZE
+        offset += HEADER_SIZE
+        buffer[offset:offset + payload_size] = \
+            memoryview(self.payload)[start:start + payload_size]
+        return HEADER_SIZE + payload_size
+
+    def message_size(self):
+        """Return the total size in bytes of all UDP messages of this packet"""
+        return HEADER_SIZE * self.num_packets() + sum(
+            self.get_payload_size(n) for n in range(1, self.num_packets() + 1))
+
+    def udp_messages(self, buffer=None):
+        """Write all UDP messages of this packet contiguously into a buffer and
+        return a list of memoryview slices of it, one per UDP message
 
-        payload = self.payload[ (packetnum-1) * MAX_PAYLOAD_SIZE :
-                                (packetnum-1) * MAX_PAYLOAD_SIZE+
-                                self.get_payload_size(packetnum) ]
-        return header + payload
+        Keyword arguments:
+        buffer -- bytearray or writable memoryview of at least message_size()
+                  bytes to write the messages into. If None (default), one is
+                  allocated.
+        """
+        if buffer is None:
+            buffer = bytearray(self.message_size())
+        view = memoryview(buffer)
+        messages = []
+        offset = 0
+        for packetnum in range(1, self.num_packets() + 1):
+            size = self.pack_into(view, offset, packetnum)
+            messages.append(view[offset:offset + size])
+            offset += size
+        return messages
 
     def send(self, sock, addr, uid=UNIQUE_IDENTIFICATION):
         """Send the entire message to the specified socket and address.
@@ -257,8 +303,8 @@ class Packet:
         uid  -- unique identification
         """
         self.uid = uid
-        for a in range ( 0, self.num_packets() ):
-            sock.sendto(self.get_udp_message(a+1), addr)
+        for message in self.udp_messages():
+            sock.sendto(message, addr)
         return True
 
 
@@ -268,6 +314,8 @@ class PacketHELO (Packet):
     A HELO packet establishes a valid connection to XBMC. It is the
     first packet that should be sent.
     """
+    __slots__ = ('icontype',)
+
     def __init__(self, devicename=None, icon_type=ICON_NONE, icon_file=None):
         """
         Keyword arguments:
@@ -293,6 +341,8 @@ class PacketNOTIFICATION (Packet):
     This packet displays a notification window in XBMC. It can contain
     a caption, a message and an icon.
     """
+    __slots__ = ('title', 'message')
+
     def __init__(self, title, message, icon_type=ICON_NONE, icon_file=None):
         """
         Keyword arguments:
@@ -318,6 +368,8 @@ class PacketBUTTON (Packet):
 
     A button packet send a key press or release event to XBMC
     """
+    __slots__ = ('flags', 'code', 'amount')
+
     def __init__(self, code=0, repeat=1, down=1, queue=0,
                  map_name="", button_name="", amount=0, axis=0):
         """
@@ -391,6 +443,8 @@ class PacketMOUSE (Packet):
 
     A MOUSE packets sets the mouse position in XBMC
     """
+    __slots__ = ('flags',)
+
     def __init__(self, x, y):
         """
         Arguments:
@@ -411,6 +465,8 @@ class PacketBYE (Packet):
 
     A BYE packet terminates the connection to XBMC.
     """
+    __slots__ = ()
+
     def __init__(self):
         Packet.__init__(self)
         self.packettype = PT_BYE
@@ -423,6 +479,8 @@ class PacketPING (Packet):
     packets act as ping (not just this one). A client needs to ping
     XBMC at least once in 60 seconds or it will time out.
     """
+    __slots__ = ()
+
     def __init__(self):
         Packet.__init__(self)
         self.packettype = PT_PING
@@ -432,6 +490,8 @@ class PacketLOG (Packet):
 
     A LOG packet tells XBMC to log the message to xbmc.log with the loglevel as specified.
     """
+    __slots__ = ()
+
     def __init__(self, loglevel=0, logmessage="", autoprint=True):
         """
         Keyword arguments:
@@ -452,6 +512,8 @@ class PacketACTION (Packet):
     An ACTION packet tells XBMC to do the action specified, based on the type it knows were it needs to be sent.
     The idea is that this will be as in scripting/skining and keymapping, just triggered from afar.
     """
+    __slots__ = ()
+
     def __init__(self, actionmessage="", actiontype=ACTION_EXECBUILTIN):
         """
         Keyword arguments:
@@ -464,6 +526,109 @@ class PacketACTION (Packet):
         self.append_payload( chr (actiontype) )
         self.append_payload( format_string(actionmessage) )
 
+######################################################################
+# Packet Decoding
+######################################################################
+
+PacketHeader = namedtuple('PacketHeader', ['sig', 'majver', 'minver',
+                                           'packettype', 'seq', 'maxseq',
+                                           'payloadsize', 'uid', 'reserved'])
+
+ActionPayload = namedtuple('ActionPayload', ['actiontype', 'actionmessage'])
+
+ButtonPayload = namedtuple('ButtonPayload', ['code', 'flags', 'amount',
+                                             'map_name', 'button_name'])
+
+HeloPayload = namedtuple('HeloPayload', ['devicename', 'icon_type'])
+
+
+def parse_header(data):
+    """Parse the header of a UDP message and return it as a PacketHeader.
+    Raises ValueError if the message is too short or not an XBMC packet.
+
+    Arguments:
+    data -- the UDP message, as bytes, bytearray or memoryview
+    """
+    if len(data) < HEADER_SIZE:
+        raise ValueError("message shorter than packet header")
+    header = PacketHeader._make(HEADER.unpack_from(data))
+    if header.sig != b"XBMC":
+        raise ValueError("invalid packet signature")
+    if len(data) < HEADER_SIZE + header.payloadsize:
+        raise ValueError("message shorter than its payload size")
+    return header
+
+
+def _split_strings(data, count):
+    """Split count null-terminated strings from the start of data, returning
+    them decoded, along with the remaining data"""
+    strings = []
+    for _ in range(count):
+        end = data.index(b"\0")
+        strings.append(bytes(data[:end]).decode())
+        data = data[end + 1:]
+    return strings, data
+
+
+def decode_payload(packettype, payload):
+    """Decode the payload of a complete message of the given packet type.
+    Returns an ActionPayload, ButtonPayload or HeloPayload for PT_ACTION,
+    PT_BUTTON and PT_HELO messages respectively, and the raw payload as bytes
+    for other packet types.
+    """
+    payload = bytes(payload)
+    if packettype == PT_ACTION:
+        (actionmessage,), _ = _split_strings(payload[1:], 1)
+        return ActionPayload(payload[0], actionmessage)
+    if packettype == PT_BUTTON:
+        code, flags, amount = Struct("!HHH").unpack_from(payload)
+        (map_name, button_name), _ = _split_strings(payload[6:], 2)
+        return ButtonPayload(code, flags, amount, map_name, button_name)
+    if packettype == PT_HELO:
+        (devicename,), rest = _split_strings(payload, 1)
+        return HeloPayload(devicename, rest[0])
+    return payload
+
+
+class MessageAssembler:
+    """Reassembles multi-packet messages from their UDP messages.
+
+    Messages are tracked per client unique token, so messages from different
+    clients may be interleaved. Packets of a message may arrive in any order.
+    """
+    def __init__(self):
+        # uid -> {seq: (header, payload)} for incomplete messages
+        self.partial = {}
+
+    def feed(self, data):
+        """Process one UDP message. Returns a (header, payload) tuple if it
+        completes a message, otherwise None. The returned header is that of
+        the first packet of the message, with payloadsize set to the size of
+        the whole reassembled payload.
+
+        Arguments:
+        data -- the UDP message, as bytes, bytearray or memoryview
+        """
+        header = parse_header(data)
+        payload = bytes(data[HEADER_SIZE:HEADER_SIZE + header.payloadsize])
+        if header.maxseq <= 1:
+            return header, payload
+        packets = self.partial.setdefault(header.uid, {})
+        if any(h.maxseq != header.maxseq for h, _ in packets.values()):
+            # A different message, remaining packets of the previous one
+            # were lost:
+            packets.clear()
+        packets[header.seq] = (header, payload)
+        if len(packets) < header.maxseq:
+            return None
+        del self.partial[header.uid]
+        if sorted(packets) != list(range(1, header.maxseq + 1)):
+            return None
+        first_header = packets[1][0]
+        payload = b"".join(packets[seq][1] for seq in sorted(packets))
+        return first_header._replace(payloadsize=len(payload)), payload
+
+
 ######################################################################
 # XBMC Client Class
 ######################################################################
@@ -0,0 +1,83 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Datagrams sent to Kodi per second of holding each media key.
+
+Feeds KodiClient a synthetic press, autorepeats at REPEAT_RATE after
+REPEAT_DELAY, and release, with kernel timestamps spaced accordingly, and
+counts the datagrams a local EventServer receives. Run with:
+
+    python3 benchmarks/bench_autorepeat.py
+"""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from evdev import InputEvent
+import evdev.ecodes as ev
+
+from DElauncher4Kodi.key_redirection import (KodiClient, MEDIA_KEYS, PRESS,
+                                             HOLD, RELEASE)
+from DElauncher4Kodi.eventserver import EventServer
+
+HOLD_DURATION = 5.0
+REPEAT_DELAY = 0.25
+REPEAT_RATE = 33.0
+
+
+def key_event(t, key, value):
+    sec = int(t)
+    return InputEvent(sec, int((t - sec) * 1e6), ev.EV_KEY, key, value)
+
+
+def hold(key, start_time):
+    """Return the events of holding the key for HOLD_DURATION"""
+    events = [key_event(start_time, key, PRESS)]
+    t = start_time + REPEAT_DELAY
+    while t < start_time + HOLD_DURATION:
+        events.append(key_event(t, key, HOLD))
+        t += 1 / REPEAT_RATE
+    events.append(key_event(start_time + HOLD_DURATION, key, RELEASE))
+    return events
+
+
+def main():
+    print(f'Datagrams per second of holding each key for {HOLD_DURATION} s '
+          f'with {REPEAT_RATE} Hz autorepeat:')
+    print(f'  {"action":<14} {"every repeat":>12} {"rate limited":>12}')
+    with EventServer() as server:
+        client = KodiClient([server.addr])
+        # The HELO:
+        server.wait_for(1, timeout=5)
+        start_time = 1e9
+        for key, action in MEDIA_KEYS.items():
+            events = hold(key, start_time)
+            start_time += HOLD_DURATION + 1
+            unlimited = sum(1 for e in events if e.value in [PRESS, HOLD])
+            n_received = server.n_packets
+            n_sent = client.n_sent
+            for event in events:
+                client.handle_event(event)
+            server.wait_for(n_received + client.n_sent - n_sent, timeout=5)
+            limited = server.n_packets - n_received
+            print(f'  {action:<14} {unlimited / HOLD_DURATION:12.1f} '
+                  f'{limited / HOLD_DURATION:12.1f}')
+
+
+if __name__ == '__main__':
+    main()
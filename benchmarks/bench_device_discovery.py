@@ -0,0 +1,73 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Time taken to find the input devices with media keys on this machine, with
+and without prefiltering them by their key bitmaps in sysfs.
+
+Needs read access to the devices in /dev/input, for example by being in the
+input group. Run with:
+
+    python3 benchmarks/bench_device_discovery.py
+"""
+
+import sys
+import os
+import io
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import evdev
+
+from DElauncher4Kodi import key_redirection
+from DElauncher4Kodi.keymap import KeyMap
+
+REPEATS = 10
+
+
+def time_discovery():
+    best = float('inf')
+    for _ in range(REPEATS):
+        start_time = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            devices, _ = key_redirection.get_mediakey_devices(
+                KeyMap(key_redirection.DEFAULT_BINDINGS))
+        best = min(best, time.perf_counter() - start_time)
+        for device in devices:
+            device.close()
+    return best, len(devices)
+
+
+def main():
+    n_nodes = len(evdev.list_devices())
+    print(f'Finding media key devices among {n_nodes} input devices, '
+          f'best of {REPEATS}')
+    prefiltered, n_found = time_discovery()
+    sysfs_input = key_redirection.SYSFS_INPUT
+    # Make sysfs unreadable so that every device is opened and asked:
+    key_redirection.SYSFS_INPUT = '/nonexistent'
+    try:
+        unfiltered, _ = time_discovery()
+    finally:
+        key_redirection.SYSFS_INPUT = sysfs_input
+    print(f'  {n_found} found')
+    print(f'  opening every device: {unfiltered * 1e3:8.2f} ms')
+    print(f'  sysfs prefilter:      {prefiltered * 1e3:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Per-event cost of sending a media key action to several Kodi eventservers,
+with one sendmmsg() system call versus a sendto() per eventserver.
+
+The eventservers are stand-in UDP sockets in a child process, so that
+receiving does not compete with the sender for the GIL. One of them never
+reads, like a stalled remote Kodi, to show that sending to the others is
+unaffected. Run with:
+
+    python3 benchmarks/bench_fanout.py
+"""
+
+import sys
+import os
+import timeit
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from evdev import InputEvent
+import evdev.ecodes as ev
+
+from DElauncher4Kodi.key_redirection import KodiClient, PRESS
+
+TARGET_COUNTS = [1, 2, 4, 8]
+N_EVENTS = 50000
+
+# Binds the given number of sockets, prints their ports, and reads from all
+# but the last until stdin is closed:
+RECEIVERS = '''
+import sys, socket, selectors, threading
+socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(%d)]
+for sock in socks:
+    sock.bind(('127.0.0.1', 0))
+print(' '.join(str(sock.getsockname()[1]) for sock in socks), flush=True)
+selector = selectors.DefaultSelector()
+for sock in socks[:-1]:
+    sock.setblocking(False)
+    selector.register(sock, selectors.EVENT_READ)
+def drain():
+    while True:
+        for key, _ in selector.select():
+            try:
+                while True:
+                    key.fileobj.recv(2048)
+            except BlockingIOError:
+                pass
+threading.Thread(target=drain, daemon=True).start()
+sys.stdin.read()
+'''
+
+
+def main():
+    n_receivers = max(TARGET_COUNTS) + 1
+    receivers = subprocess.Popen([sys.executable, '-c', RECEIVERS % n_receivers],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+    try:
+        ports = [int(port) for port in receivers.stdout.readline().split()]
+        targets = [('127.0.0.1', port) for port in ports[:-1]]
+        stalled = ('127.0.0.1', ports[-1])
+        event = InputEvent(0, 0, ev.EV_KEY, ev.KEY_PLAYPAUSE, PRESS)
+        print(f'{N_EVENTS} actions, best of 5, us/action:')
+        print(f'  {"targets":>7} {"sendmmsg":>9} {"sendto":>9}')
+        for n_targets in TARGET_COUNTS:
+            results = []
+            for use_sendmmsg in [True, False]:
+                client = KodiClient(targets[:n_targets],
+                                    use_sendmmsg=use_sendmmsg)
+                best = min(timeit.repeat(lambda: client.handle_event(event),
+                                         number=N_EVENTS, repeat=5))
+                results.append(best / N_EVENTS * 1e6)
+                client.close()
+            print(f'  {n_targets:7d} {results[0]:9.2f} {results[1]:9.2f}')
+        client = KodiClient([targets[0], stalled])
+        best = min(timeit.repeat(lambda: client.handle_event(event),
+                                 number=N_EVENTS, repeat=5))
+        print(f'  1 + stalled target: {best / N_EVENTS * 1e6:.2f}, '
+              f'{client.n_send_errors} send errors')
+        client.close()
+    finally:
+        receivers.stdin.close()
+        receivers.wait()
+
+
+if __name__ == '__main__':
+    main()
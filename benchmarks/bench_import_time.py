@@ -0,0 +1,67 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Time taken to import DElauncher4Kodi.__main__, and where it goes.
+
+Imports the module in fresh interpreters with python -X importtime, and
+reports the best cumulative import time of the package's modules and of
+their slowest dependencies. The time budget is enforced by
+tests/test_import_time.py. Run with:
+
+    python3 benchmarks/bench_import_time.py
+"""
+
+import sys
+import os
+import subprocess
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULE = 'DElauncher4Kodi.__main__'
+REPEATS = 5
+N_SLOWEST = 5
+
+
+def import_times():
+    """Import MODULE in a new interpreter and return a dict of each imported
+    module's cumulative import time in seconds"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             f'import {MODULE}'],
+                            cwd=PACKAGE_DIR, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def main():
+    runs = [import_times() for _ in range(REPEATS)]
+    best = min(runs, key=lambda times: times[MODULE])
+    total = best[MODULE]
+    print(f'import {MODULE}: {total * 1e3:.1f} ms (best of {REPEATS})')
+    print('Slowest imports:')
+    slowest = sorted(best.items(), key=lambda item: item[1], reverse=True)
+    slowest = [item for item in slowest if item[0] != MODULE]
+    for name, cumulative in slowest[:N_SLOWEST]:
+        print(f'  {name:<40} {cumulative * 1e3:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
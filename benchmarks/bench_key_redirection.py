@@ -0,0 +1,221 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Synthetic-input benchmarks of the KeyRedirection event pipeline.
+
+Input devices are replaced with pipes that struct input_event frames are
+written to, read by evdev exactly as it reads real device nodes. Events are
+run through KeyRedirection.redirect(), with uinput replaced by a pipe that is
+drained and counted in a thread, and Kodi replaced by a local EventServer.
+No input devices, uinput access or Kodi are needed. Run with:
+
+    python3 benchmarks/bench_key_redirection.py
+
+Two workloads are run at 1, 4 and 16 devices:
+
+  keyboard -- unpaced typing-like frames (MSC_SCAN, KEY, SYN), one frame in
+              ten being a media key sent to Kodi. Measures throughput.
+  mouse    -- REL_X, REL_Y, SYN frames paced at 1000 Hz per device, as from a
+              gaming mouse. Measures latency under a steady load.
+"""
+
+import sys
+import os
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import evdev.ecodes as ev
+from evdev.device import DeviceInfo
+from evdev.eventio import EventIO
+
+from DElauncher4Kodi.key_redirection import (KeyRedirection, KodiClient,
+                                             FrameWriter, INPUT_EVENT, PRESS,
+                                             RELEASE)
+from DElauncher4Kodi.eventserver import EventServer
+from DElauncher4Kodi.latency import LatencyTrace
+
+DEVICE_COUNTS = [1, 4, 16]
+KEYBOARD_FRAMES_PER_DEVICE = 20000
+MOUSE_RATE = 1000
+MOUSE_DURATION = 2.0
+# Frames written to a device pipe at once, well under PIPE_BUF so that
+# writes are atomic:
+CHUNK_FRAMES = 32
+
+
+class PipeDevice(EventIO):
+    """Stand-in for evdev.InputDevice, reading events from a pipe"""
+    def __init__(self, n):
+        self.fd, self.writer = os.pipe()
+        os.set_blocking(self.fd, False)
+        self.fn = f'/nonexistent/benchmark-event{n}'
+        self.name = f'benchmark device {n}'
+        self.info = DeviceInfo(bustype=0, vendor=0, product=0, version=0)
+
+    def close_writer(self):
+        os.close(self.writer)
+
+
+class CaptureUInput(object):
+    """Stand-in for evdev.UInput, counting the events written to it"""
+    def __init__(self):
+        self.reader, self.fd = os.pipe()
+        self.n_events = 0
+        self.thread = Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            data = os.read(self.reader, 65536)
+            if not data:
+                return
+            self.n_events += len(data) // INPUT_EVENT.size
+
+    def close(self):
+        os.close(self.fd)
+        self.thread.join()
+        os.close(self.reader)
+
+
+def pack_event(event_type, code, value):
+    now = time.time()
+    sec = int(now)
+    return INPUT_EVENT.pack(sec, int((now - sec) * 1e6), event_type, code, value)
+
+
+def keyboard_frame(i):
+    """Return (frame, n_events_to_uinput, n_kodi_actions) for frame number i"""
+    if i % 10 == 0:
+        code, value = ev.KEY_PLAYPAUSE, PRESS
+    else:
+        code, value = ev.KEY_A + i % 26, RELEASE if i % 2 else PRESS
+    frame = (pack_event(ev.EV_MSC, ev.MSC_SCAN, code) +
+             pack_event(ev.EV_KEY, code, value) +
+             pack_event(ev.EV_SYN, ev.SYN_REPORT, 0))
+    if code == ev.KEY_PLAYPAUSE:
+        # The scan code and SYN_REPORT are still forwarded:
+        return frame, 2, 1
+    return frame, 3, 0
+
+
+def mouse_frame(i):
+    frame = (pack_event(ev.EV_REL, ev.REL_X, 1 - 2 * (i % 2)) +
+             pack_event(ev.EV_REL, ev.REL_Y, 1) +
+             pack_event(ev.EV_SYN, ev.SYN_REPORT, 0))
+    return frame, 3, 0
+
+
+def feed_keyboard(device, counts):
+    for start in range(0, KEYBOARD_FRAMES_PER_DEVICE, CHUNK_FRAMES):
+        chunk = []
+        for i in range(start, min(start + CHUNK_FRAMES,
+                                  KEYBOARD_FRAMES_PER_DEVICE)):
+            frame, n_uinput, n_kodi = keyboard_frame(i)
+            chunk.append(frame)
+            counts[0] += n_uinput
+            counts[1] += n_kodi
+        write_all(device.writer, b''.join(chunk))
+
+
+def feed_mouse(device, counts):
+    n_frames = int(MOUSE_RATE * MOUSE_DURATION)
+    start_time = time.monotonic()
+    for i in range(n_frames):
+        frame, n_uinput, _ = mouse_frame(i)
+        delay = start_time + i / MOUSE_RATE - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        counts[0] += n_uinput
+        write_all(device.writer, frame)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def run(workload, n_devices):
+    feed = {'keyboard': feed_keyboard, 'mouse': feed_mouse}[workload]
+    trace = LatencyTrace(size=1 << 20)
+    redirector = KeyRedirection(trace=trace)
+    redirector.stop_fd_reader, redirector.stop_fd_writer = os.pipe()
+    devices = [PipeDevice(n) for n in range(n_devices)]
+    ui = CaptureUInput()
+    server = EventServer()
+    server.start()
+    kodi_client = KodiClient([server.addr], trace=trace)
+    frames = FrameWriter(ui, trace=trace)
+
+    cpu_time = []
+
+    def redirect():
+        start_cpu = time.thread_time()
+        redirector.redirect(devices, kodi_client, frames)
+        cpu_time.append(time.thread_time() - start_cpu)
+
+    redirect_thread = Thread(target=redirect)
+    redirect_thread.start()
+
+    counts = [[0, 0] for _ in devices]
+    feeders = [Thread(target=feed, args=(device, device_counts))
+               for device, device_counts in zip(devices, counts)]
+    start_time = time.monotonic()
+    for feeder in feeders:
+        feeder.start()
+    for feeder in feeders:
+        feeder.join()
+    n_uinput = sum(c[0] for c in counts)
+    n_kodi = sum(c[1] for c in counts)
+    # Wait for everything to come out the other end:
+    deadline = time.monotonic() + 10
+    while ui.n_events < n_uinput and time.monotonic() < deadline:
+        time.sleep(0.001)
+    # Plus the HELO:
+    server.wait_for(n_kodi + 1, timeout=max(0, deadline - time.monotonic()))
+    elapsed = time.monotonic() - start_time
+
+    os.write(redirector.stop_fd_writer, b'stop')
+    redirect_thread.join()
+    for device in devices:
+        device.close_writer()
+    ui.close()
+    server.stop()
+
+    n_events = n_uinput + n_kodi
+    lost = n_kodi - len(server.actions())
+    latencies = sorted(trace.uinput.samples[:min(trace.uinput.count,
+                                                 trace.uinput.size)])
+    p50 = latencies[len(latencies) // 2] * 1e3
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e3
+    print(f'  {workload:<8} {n_devices:3d} devices: '
+          f'{n_events / elapsed:9.0f} events/s, '
+          f'{cpu_time[0] / n_events * 1e6:6.2f} us CPU/event, '
+          f'frame latency p50 {p50:6.3f} ms p99 {p99:6.3f} ms, '
+          f'{lost} Kodi actions lost')
+
+
+def main():
+    print('KeyRedirection pipeline benchmark:')
+    for workload in ['keyboard', 'mouse']:
+        for n_devices in DEVICE_COUNTS:
+            run(workload, n_devices)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Microbenchmark of the per-event cost of sending a media key action to Kodi.
+
+Compares building a PacketACTION for every event (as was done previously)
+against dispatching press events through KodiClient's table of handlers
+sending precompiled datagrams. Datagrams
+are sent to a local UDP socket that is drained in the background so that the
+socket buffer does not fill up. Run with:
+
+    python3 benchmarks/bench_kodi_client.py
+"""
+
+import sys
+import os
+import timeit
+from socket import socket, AF_INET, SOCK_DGRAM
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from evdev import InputEvent
+import evdev.ecodes as ev
+
+from DElauncher4Kodi.key_redirection import (KodiClient, MEDIA_KEYS, KEY_CNT,
+                                             PRESS)
+from DElauncher4Kodi.xbmcclient import PacketACTION, ACTION_BUTTON
+
+N_EVENTS = 100000
+
+
+def drain(sock):
+    while True:
+        try:
+            sock.recv(2048)
+        except OSError:
+            return
+
+
+def main():
+    receiver = socket(AF_INET, SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    Thread(target=drain, args=(receiver,), daemon=True).start()
+    host, port = receiver.getsockname()
+
+    client = KodiClient([(host, port)])
+    keys = list(MEDIA_KEYS)
+    events = [InputEvent(0, 0, ev.EV_KEY, key, PRESS) for key in keys]
+
+    def per_event_packet():
+        for i in range(N_EVENTS):
+            action = MEDIA_KEYS[keys[i % len(keys)]]
+            packet = PacketACTION(actionmessage=action, actiontype=ACTION_BUTTON)
+            packet.send(client.sock, (host, port))
+
+    def precompiled():
+        for i in range(N_EVENTS):
+            client.handle_event(events[i % len(events)])
+
+    def encode_only():
+        for i in range(N_EVENTS):
+            action = MEDIA_KEYS[keys[i % len(keys)]]
+            packet = PacketACTION(actionmessage=action, actiontype=ACTION_BUTTON)
+            packet.get_udp_message()
+
+    def lookup_only():
+        for i in range(N_EVENTS):
+            event = events[i % len(events)]
+            client.table[event.type * KEY_CNT + event.code]
+
+    print(f'{N_EVENTS} events, best of 5:')
+    for name, func in [('build PacketACTION + send', per_event_packet),
+                       ('dispatch table + send', precompiled),
+                       ('build PacketACTION only', encode_only),
+                       ('table lookup only', lookup_only)]:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print(f'  {name:<28} {best / N_EVENTS * 1e6:7.2f} us/event')
+    receiver.close()
+
+
+if __name__ == '__main__':
+    main()
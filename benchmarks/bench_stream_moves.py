@@ -0,0 +1,103 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Benchmark of moving many audio streams between sinks, one move per round
+trip as was done previously, versus pipelined with move_streams().
+
+Requires a running PulseAudio (or pipewire-pulse) server and pacat. Silent
+playback streams are created with pacat, and moved back and forth between
+two null sinks created for the purpose. Run with:
+
+    python3 benchmarks/bench_stream_moves.py
+"""
+
+import sys
+import os
+import time
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pulsectl
+
+from DElauncher4Kodi.volume_adjustment import move_streams
+
+STREAM_COUNTS = [1, 10, 50, 100]
+CLIENT_NAME = 'DElauncher4Kodi-benchmark'
+REPEATS = 5
+
+
+def move_serially(pulse, moves):
+    for index, sink in moves:
+        pulse.sink_input_move(index, sink)
+
+
+def wait_for_streams(pulse, n_streams, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        streams = [s for s in pulse.sink_input_list()
+                   if s.proplist.get('application.name') == CLIENT_NAME]
+        if len(streams) >= n_streams:
+            return streams
+        time.sleep(0.05)
+    raise RuntimeError('Benchmark streams did not appear')
+
+
+def run(pulse, sinks, n_streams):
+    players = [subprocess.Popen(['pacat', f'--client-name={CLIENT_NAME}',
+                                 f'--device={sinks[0].name}', '--volume=0',
+                                 '/dev/zero'])
+               for _ in range(n_streams)]
+    try:
+        streams = wait_for_streams(pulse, n_streams)
+        results = {}
+        for name, mover in [('serial', move_serially),
+                            ('pipelined', move_streams)]:
+            best = float('inf')
+            for i in range(REPEATS):
+                target = sinks[(i + 1) % 2]
+                moves = [(s.index, target.index) for s in streams]
+                start_time = time.perf_counter()
+                mover(pulse, moves)
+                best = min(best, time.perf_counter() - start_time)
+            results[name] = best
+        print(f'  {n_streams:4d} streams: '
+              f'serial {results["serial"] * 1e3:8.2f} ms, '
+              f'pipelined {results["pipelined"] * 1e3:8.2f} ms')
+    finally:
+        for player in players:
+            player.terminate()
+        for player in players:
+            player.wait()
+
+
+def main():
+    with pulsectl.Pulse(CLIENT_NAME) as pulse:
+        modules = [pulse.module_load('module-null-sink',
+                                     f'sink_name=DElauncher4Kodi.bench{i}')
+                   for i in range(2)]
+        try:
+            sinks = [s for s in pulse.sink_list() if s.owner_module in modules]
+            print('Moving streams between sinks, best of', REPEATS)
+            for n_streams in STREAM_COUNTS:
+                run(pulse, sinks, n_streams)
+        finally:
+            for module in modules:
+                pulse.module_unload(module)
+
+
+if __name__ == '__main__':
+    main()
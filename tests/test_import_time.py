@@ -0,0 +1,62 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Checks that importing DElauncher4Kodi.__main__ stays within its time
+budget, and does not import what is only needed once a subsystem starts. See
+benchmarks/bench_import_time.py for a breakdown of where the time goes."""
+
+import os
+import sys
+import subprocess
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULE = 'DElauncher4Kodi.__main__'
+# Seconds:
+BUDGET = 0.050
+REPEATS = 5
+# Top-level modules that must not be imported until their subsystem starts:
+DEFERRED = ['evdev', 'pulsectl', 'asyncio', 'DElauncher4Kodi.key_redirection',
+            'DElauncher4Kodi.volume_adjustment', 'DElauncher4Kodi.xbmcclient',
+            'DElauncher4Kodi.keymap', 'DElauncher4Kodi.batchsend',
+            'DElauncher4Kodi.metrics']
+
+
+def import_times():
+    """Import MODULE in a new interpreter and return a dict of each imported
+    module's cumulative import time in seconds"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             f'import {MODULE}'],
+                            cwd=PACKAGE_DIR, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_import_time():
+    best = min((import_times() for _ in range(REPEATS)),
+               key=lambda times: times[MODULE])
+    deferred = [name for name in best
+                if any(name == d or name.startswith(d + '.') for d in DEFERRED)]
+    assert not deferred, 'Imported before being needed'
+    assert best[MODULE] <= BUDGET, (
+        f'import {MODULE} took {best[MODULE] * 1e3:.1f} ms, ' +
+        f'budget {BUDGET * 1e3:.1f} ms')
@@ -0,0 +1,157 @@
+#   Copyright (C) 2018 Chris Billington
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Checks that xbmcclient encodes packets byte for byte as the original
+encoder did, and that the encoded datagrams decode back to what was sent."""
+
+import socket
+
+import pytest
+
+from DElauncher4Kodi.xbmcclient import (PacketACTION, PacketBUTTON, PacketHELO,
+                                        PacketBYE, PacketPING, ACTION_BUTTON,
+                                        ACTION_EXECBUILTIN, PT_ACTION, PT_BLOB,
+                                        PT_BUTTON, PT_HELO, HEADER_SIZE,
+                                        MAX_PAYLOAD_SIZE, parse_header,
+                                        decode_payload, MessageAssembler)
+
+UID = 0x12345678
+
+# Datagrams produced by the original string-concatenating encoder for UID:
+KNOWN_GOOD = [
+    (lambda: PacketACTION('PlayPause', ACTION_BUTTON),
+     '58424d430200000a0000000100000001000b1234567800000000000000000000'
+     '02506c6179506175736500'),
+    (lambda: PacketACTION('ActivateWindow(Home)'),
+     '58424d430200000a000000010000000100161234567800000000000000000000'
+     '01416374697661746557696e646f7728486f6d652900'),
+    (lambda: PacketBUTTON(map_name='R1', button_name='play', repeat=0, down=1),
+     '58424d43020000030000000100000001000e1234567800000000000000000000'
+     '0000002b0000523100706c617900'),
+    (lambda: PacketBUTTON(map_name='R1', button_name='play', repeat=0, down=0),
+     '58424d43020000030000000100000001000e1234567800000000000000000000'
+     '0000002d0000523100706c617900'),
+    (lambda: PacketHELO(devicename='DElauncher4Kodi'),
+     '58424d43020000010000000100000001001b1234567800000000000000000000'
+     '44456c61756e63686572344b6f6469000000000000000000000000'),
+    (lambda: PacketBYE(),
+     '58424d4302000002000000010000000100001234567800000000000000000000'),
+    (lambda: PacketPING(),
+     '58424d4302000005000000010000000100001234567800000000000000000000'),
+]
+
+# A 1500 character action needs two packets, the second a PT_BLOB:
+LONG_ACTION = 'A' * 1500
+LONG_ACTION_DATAGRAMS = [
+    bytes.fromhex('58424d430200000a000000010000000203e0'
+                  '1234567800000000000000000000')
+    + b'\x02' + b'A' * (MAX_PAYLOAD_SIZE - 1),
+    bytes.fromhex('58424d4302000008000000020000000201fe'
+                  '1234567800000000000000000000')
+    + b'A' * (len(LONG_ACTION) - MAX_PAYLOAD_SIZE + 1) + b'\0',
+]
+
+
+def make(factory):
+    packet = factory()
+    packet.uid = UID
+    return packet
+
+
+def received(packet):
+    """Send the packet with send() over UDP on localhost and return the
+    datagrams received"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        packet.send(sender, receiver.getsockname(), uid=UID)
+        return [receiver.recv(2048) for _ in range(packet.num_packets())]
+
+
+@pytest.mark.parametrize('factory, expected', KNOWN_GOOD)
+def test_known_good(factory, expected):
+    packet = make(factory)
+    expected = bytes.fromhex(expected)
+    assert packet.get_udp_message() == expected
+    assert [bytes(m) for m in packet.udp_messages()] == [expected]
+    assert received(packet) == [expected]
+
+
+def test_multi_packet_action():
+    packet = make(lambda: PacketACTION(LONG_ACTION, ACTION_BUTTON))
+    assert packet.num_packets() == 2
+    messages = [packet.get_udp_message(n) for n in (1, 2)]
+    assert messages == LONG_ACTION_DATAGRAMS
+    assert [bytes(m) for m in packet.udp_messages()] == LONG_ACTION_DATAGRAMS
+    assert received(packet) == LONG_ACTION_DATAGRAMS
+
+
+def test_pack_into_offset():
+    packet = make(lambda: PacketACTION('PlayPause', ACTION_BUTTON))
+    buffer = bytearray(100)
+    size = packet.pack_into(buffer, 10)
+    assert bytes(buffer[10:10 + size]) == packet.get_udp_message()
+
+
+def test_round_trip_action():
+    header, payload = MessageAssembler().feed(
+        bytes.fromhex(KNOWN_GOOD[1][1]))
+    assert header.packettype == PT_ACTION
+    assert header.uid == UID
+    action = decode_payload(header.packettype, payload)
+    assert (action.actiontype, action.actionmessage) == (
+        ACTION_EXECBUILTIN, 'ActivateWindow(Home)')
+
+
+def test_round_trip_button():
+    data = bytes.fromhex(KNOWN_GOOD[2][1])
+    header = parse_header(data)
+    assert header.packettype == PT_BUTTON
+    assert header.payloadsize == len(data) - HEADER_SIZE
+    button = decode_payload(PT_BUTTON, data[HEADER_SIZE:])
+    assert (button.map_name, button.button_name) == ('R1', 'play')
+
+
+def test_round_trip_helo():
+    data = bytes.fromhex(KNOWN_GOOD[4][1])
+    header, payload = MessageAssembler().feed(data)
+    assert header.packettype == PT_HELO
+    assert decode_payload(PT_HELO, payload).devicename == 'DElauncher4Kodi'
+
+
+@pytest.mark.parametrize('order', [(0, 1), (1, 0)])
+def test_round_trip_multi_packet_action(order):
+    assembler = MessageAssembler()
+    first, second = (LONG_ACTION_DATAGRAMS[i] for i in order)
+    assert parse_header(LONG_ACTION_DATAGRAMS[1]).packettype == PT_BLOB
+    assert assembler.feed(first) is None
+    header, payload = assembler.feed(second)
+    assert header.packettype == PT_ACTION
+    assert header.payloadsize == len(LONG_ACTION) + 2
+    action = decode_payload(header.packettype, payload)
+    assert (action.actiontype, action.actionmessage) == (
+        ACTION_BUTTON, LONG_ACTION)
+
+
+def test_parse_header_rejects_invalid():
+    data = bytes.fromhex(KNOWN_GOOD[0][1])
+    with pytest.raises(ValueError):
+        parse_header(data[:HEADER_SIZE - 1])
+    with pytest.raises(ValueError):
+        parse_header(b'XBMX' + data[4:])
+    with pytest.raises(ValueError):
+        parse_header(data[:-1])